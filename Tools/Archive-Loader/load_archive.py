@@ -0,0 +1,94 @@
+import argparse
+import base64
+import glob
+import gzip
+import json
+import os
+import sqlite3
+import time
+
+columns = ['encounter_id', 'spawnpoint_id', 'pokemon_id', 'latitude', 'longitude', 'disappear_time']
+
+
+def archive_files(archive_dir, first, last):
+    files = []
+    for path in sorted(glob.glob(os.path.join(archive_dir, 'pokemon-*.ndjson.gz'))):
+        day = os.path.basename(path)[len('pokemon-'):-len('.ndjson.gz')]
+        if (first is None or day >= first) and (last is None or day <= last):
+            files.append(path)
+    return files
+
+
+def encounter_id_to_db(encounter_id):
+    # Archives have the base64 encoded ids the map and webhooks use; older
+    # ones have the signed 64 bit integers the map's database stores, which
+    # is what the loaded table keeps too.
+    if not hasattr(encounter_id, 'encode'):
+        return encounter_id
+    encounter_id = int(base64.b64decode(encounter_id))
+    if encounter_id >= 2 ** 63:
+        encounter_id -= 2 ** 64
+    return encounter_id
+
+
+def read_rows(path):
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            p = json.loads(line)
+            p['encounter_id'] = encounter_id_to_db(p['encounter_id'])
+            yield tuple(p[c] for c in columns)
+
+
+def load(db, path, batch):
+    # A crash while archiving can leave a row in the archive twice, so
+    # later copies replace earlier ones.
+    query = 'INSERT OR REPLACE INTO pokemon ({}) VALUES ({})'.format(', '.join(columns),
+                                                                     ', '.join('?' * len(columns)))
+    rows = []
+    count = 0
+    for row in read_rows(path):
+        rows.append(row)
+        if len(rows) == batch:
+            db.executemany(query, rows)
+            count += len(rows)
+            rows = []
+    db.executemany(query, rows)
+    return count + len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load days archived with --archive-dir into an SQLite database')
+    parser.add_argument('archive_dir', help='directory with the pokemon-YYYYMMDD.ndjson.gz files')
+    parser.add_argument('db', help='SQLite database to load into, created if missing')
+    parser.add_argument('-f', '--first', help='first day to load, as YYYYMMDD')
+    parser.add_argument('-l', '--last', help='last day to load, as YYYYMMDD')
+    parser.add_argument('-b', '--batch', help='rows per insert batch', type=int, default=10000)
+    args = parser.parse_args()
+
+    db = sqlite3.connect(args.db)
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('CREATE TABLE IF NOT EXISTS pokemon ('
+               'encounter_id INTEGER NOT NULL PRIMARY KEY, spawnpoint_id VARCHAR(255) NOT NULL, '
+               'pokemon_id INTEGER NOT NULL, latitude REAL NOT NULL, longitude REAL NOT NULL, '
+               'disappear_time DATETIME NOT NULL)')
+
+    files = archive_files(args.archive_dir, args.first, args.last)
+    start = time.time()
+    total = 0
+    for path in files:
+        with db:
+            count = load(db, path, args.batch)
+        total += count
+        print('{}: {} rows'.format(os.path.basename(path), count))
+
+    # Indexes are built once at the end, which is quicker than keeping
+    # them up to date while loading.
+    with db:
+        db.execute('CREATE INDEX IF NOT EXISTS pokemon_disappear_time ON pokemon (disappear_time)')
+        db.execute('CREATE INDEX IF NOT EXISTS pokemon_pokemon_id_disappear_time ON pokemon (pokemon_id, disappear_time)')
+        db.execute('CREATE INDEX IF NOT EXISTS pokemon_spawnpoint_id ON pokemon (spawnpoint_id)')
+    print('Loaded {} rows from {} files in {:.1f}s'.format(total, len(files), time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
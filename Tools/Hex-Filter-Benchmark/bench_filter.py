@@ -0,0 +1,106 @@
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+import geopy.distance
+
+# Run from anywhere in the checkout.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from pogom.transform import filter_within  # noqa: E402
+
+
+def hex_radius(steps):
+    # The radius get_spawnpoints_in_hex filters a hex of this many steps with.
+    return ((steps - 1) * 121.2436) + 70
+
+
+def edge_points(center, radius, count):
+    # Points spread over a band of 1% around the circle, where the plane
+    # approximation is closest to getting it wrong.
+    points = []
+    for i in range(count):
+        meters = radius * random.uniform(0.99, 1.01)
+        p = geopy.distance.distance(meters=meters).destination(center, random.uniform(0, 360))
+        points.append({'lat': p.latitude, 'lng': p.longitude})
+    return points
+
+
+def box_points(center, radius, count):
+    # Points spread over the bounding box, like the spawnpoints the hex
+    # query hands to the filter.
+    lat_span = radius / 111000.0
+    lng_span = lat_span / math.cos(math.radians(center[0]))
+    return [{'lat': center[0] + random.uniform(-lat_span, lat_span),
+             'lng': center[1] + random.uniform(-lng_span, lng_span)}
+            for i in range(count)]
+
+
+def geopy_within(center, points, radius):
+    return [p for p in points
+            if geopy.distance.distance(center, (p['lat'], p['lng'])).meters <= radius]
+
+
+def check_accuracy(latitudes, radius, count):
+    print('Accuracy against geopy, {} points within 1% of a {:.0f}m radius:'.format(count, radius))
+    mismatches = 0
+    for lat in latitudes:
+        center = (lat, random.uniform(-180, 180))
+        points = edge_points(center, radius, count)
+        fast = set(id(p) for p in filter_within(center, points, radius))
+        exact = set(id(p) for p in geopy_within(center, points, radius))
+        wrong = len(fast ^ exact)
+        mismatches += wrong
+        print('  latitude {:6.1f}: {} of {} inside, {} differ'.format(lat, len(exact), count, wrong))
+    return mismatches
+
+
+def benchmark(lat, radius, sizes, geopy_max):
+    print('Speed at latitude {:.1f}, {:.0f}m radius:'.format(lat, radius))
+    center = (lat, random.uniform(-180, 180))
+    for size in sizes:
+        points = box_points(center, radius, size)
+        start = time.time()
+        filter_within(center, points, radius)
+        fast = time.time() - start
+        if size > geopy_max:
+            print('  {:>8} points: filter_within {:.3f}s'.format(size, fast))
+            continue
+        start = time.time()
+        geopy_within(center, points, radius)
+        exact = time.time() - start
+        print('  {:>8} points: filter_within {:.3f}s, geopy {:.3f}s ({:.0f}x)'.format(
+            size, fast, exact, exact / max(fast, 1e-6)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check transform.filter_within against geopy and time both')
+    parser.add_argument('-st', '--step-limit', help='hex steps the radius is taken from', type=int, default=5)
+    parser.add_argument('-lat', '--latitudes', help='comma separated latitudes to check at',
+                        default='0,30,45,60,75,85')
+    parser.add_argument('-e', '--edge-points', help='points per latitude for the accuracy check',
+                        type=int, default=10000)
+    parser.add_argument('-n', '--sizes', help='comma separated point counts to time',
+                        default='10000,100000,1000000')
+    parser.add_argument('-g', '--geopy-max', help='largest point count to also time geopy for',
+                        type=int, default=100000)
+    parser.add_argument('-s', '--seed', help='random seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    radius = hex_radius(args.step_limit)
+    latitudes = [float(lat) for lat in args.latitudes.split(',')]
+
+    mismatches = check_accuracy(latitudes, radius, args.edge_points)
+    print('')
+    benchmark(latitudes[min(2, len(latitudes) - 1)], radius,
+              [int(size) for size in args.sizes.split(',')], args.geopy_max)
+
+    # Non-zero exit when the filter disagrees with geopy, for scripting.
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import argparse
+import bisect
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Run from anywhere in the checkout.
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, root)
+
+# The synthetic rows go to a table of their own, which is dropped at the end.
+bench_table = 'pokemon_index_bench'
+
+# The Pokemon indexes before schema 8, which replaced them with
+# models.pokemon_indexes.
+old_indexes = ((('spawnpoint_id',), False),
+               (('pokemon_id',), False),
+               (('disappear_time',), False),
+               (('latitude', 'longitude'), False))
+
+
+def bench_model(Pokemon):
+    # A Pokemon table without any indexes, which are added per run.
+    meta = type('Meta', (), {'db_table': bench_table, 'indexes': ()})
+    return type('PokemonIndexBench', (Pokemon,), {'Meta': meta, '__module__': __name__})
+
+
+def fill(model, bulk_upsert, run_with_retries, count, days, spawnpoints, center):
+    # Sightings spread over the last `days` days and the next 15 minutes,
+    # at spawnpoints scattered over a city sized area (~50km across).
+    now = datetime.utcnow()
+    points = [('bench%x' % random.getrandbits(40),
+               center[0] + random.uniform(-0.25, 0.25),
+               center[1] + random.uniform(-0.25, 0.25))
+              for i in range(spawnpoints)]
+    # Common species are seen far more often than rare ones.
+    species = range(1, 152)
+    cumulative = []
+    for i in species:
+        cumulative.append((cumulative[-1] if cumulative else 0) + 1.0 / (1 + i % 30))
+    span = days * 86400 + 900
+    chunk = 100000
+    for first in range(0, count, chunk):
+        rows = {}
+        for encounter_id in range(first, min(first + chunk, count)):
+            spawnpoint_id, lat, lng = random.choice(points)
+            rows[encounter_id] = {
+                'encounter_id': encounter_id,
+                'spawnpoint_id': spawnpoint_id,
+                'pokemon_id': species[bisect.bisect(cumulative, random.uniform(0, cumulative[-1])) % len(species)],
+                'latitude': lat,
+                'longitude': lng,
+                'disappear_time': now + timedelta(seconds=900 - random.randint(0, span))
+            }
+        run_with_retries(bulk_upsert, model, rows)
+        sys.stdout.write('\rFilled {} of {} rows'.format(min(first + chunk, count), count))
+        sys.stdout.flush()
+    print('')
+    # A sighting to take the species and spawnpoint of the queries from.
+    return random.choice(rows.values())
+
+
+def hot_queries(model, fn, center, sample):
+    # The reads the indexes are for, shaped like the ones in models.py.
+    now = datetime.utcnow()
+    box = ((model.latitude >= center[0] - 0.01) & (model.longitude >= center[1] - 0.01) &
+           (model.latitude <= center[0] + 0.01) & (model.longitude <= center[1] + 0.01))
+    return [
+        ('get_active box', model.select().where((model.disappear_time > now) & box)),
+        ('get_active_by_id', model.select().where((model.disappear_time > now) &
+                                                  (model.pokemon_id << [sample['pokemon_id']]) & box)),
+        ('get_expired', model.select(model.encounter_id).where((model.disappear_time > now - timedelta(seconds=30)) &
+                                                               (model.disappear_time <= now) & box)),
+        ('get_appearances 7d', model.select(model.latitude, model.longitude, model.pokemon_id,
+                                            fn.Count(model.spawnpoint_id), model.spawnpoint_id)
+                                    .where((model.pokemon_id == sample['pokemon_id']) &
+                                           (model.disappear_time > now - timedelta(days=7)))
+                                    .group_by(model.latitude, model.longitude, model.pokemon_id,
+                                              model.spawnpoint_id)),
+        ('appearance times', model.select(model.disappear_time)
+                                  .where((model.pokemon_id == sample['pokemon_id']) &
+                                         (model.spawnpoint_id == sample['spawnpoint_id']) &
+                                         (model.disappear_time > now - timedelta(days=7)))
+                                  .order_by(model.disappear_time.asc()))
+    ]
+
+
+def time_queries(queries, runs):
+    timings = []
+    for name, query in queries:
+        best = None
+        for run in range(runs):
+            start = time.time()
+            list(query.clone().tuples())
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append((name, best))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the hot Pokemon reads on a synthetic table, with the indexes from before schema 8 '
+                    'and with the composite ones. Arguments it doesn\'t know, e.g. --db-type mysql --db-host ..., '
+                    'go to the map\'s own parser to pick the database; without any it uses a scratch SQLite file.')
+    parser.add_argument('-n', '--rows', help='rows in the synthetic table', type=int, default=3000000)
+    parser.add_argument('-d', '--days', help='days of history the rows are spread over', type=int, default=30)
+    parser.add_argument('-p', '--spawnpoints', help='spawnpoints the rows are spread over', type=int, default=20000)
+    parser.add_argument('-r', '--runs', help='runs per query, the best one counts', type=int, default=3)
+    parser.add_argument('-s', '--seed', help='random seed', type=int, default=1)
+    args, pogom_args = parser.parse_known_args()
+
+    scratch = None
+    if '--db-type' not in pogom_args and '-D' not in pogom_args and '--db' not in pogom_args:
+        scratch = tempfile.mktemp(suffix='.db')
+        pogom_args += ['-D', scratch]
+    # The map's parser needs these, but the benchmark doesn't use them.
+    sys.argv = [sys.argv[0], '-os', '-l', '0,0', '-k', 'bench'] + pogom_args
+
+    from peewee import fn
+    from playhouse.migrate import migrate, MySQLMigrator, SqliteMigrator
+    from pogom import config
+    from pogom.app import Pogom
+    from pogom.utils import get_args
+    from pogom.models import (init_database, create_tables, bulk_upsert, run_with_retries,
+                              pokemon_indexes, Pokemon)
+    config['ROOT_PATH'] = root
+    db = init_database(Pogom(__name__))
+    create_tables(db)
+    db.connect()
+    migrator = MySQLMigrator(db) if get_args().db_type == 'mysql' else SqliteMigrator(db)
+
+    random.seed(args.seed)
+    center = (random.uniform(-50, 50), random.uniform(-180, 180))
+    model = bench_model(Pokemon)
+    model.drop_table(fail_silently=True)
+    model.create_table()
+    try:
+        sample = fill(model, bulk_upsert, run_with_retries, args.rows, args.days, args.spawnpoints, center)
+        queries = hot_queries(model, fn, center, sample)
+
+        results = []
+        for label, indexes in (('no', ()), ('pre-v8', old_indexes), ('composite', pokemon_indexes)):
+            if indexes:
+                start = time.time()
+                migrate(*[migrator.add_index(bench_table, columns, unique) for columns, unique in indexes])
+                print('Built the {} indexes in {:.1f}s'.format(label, time.time() - start))
+            results.append(time_queries(queries, args.runs))
+            if indexes:
+                migrate(*[migrator.drop_index(bench_table, db.compiler().index_name(bench_table, columns))
+                          for columns, unique in indexes])
+
+        print('')
+        print('{} rows over {} days, best of {} runs, in ms:'.format(args.rows, args.days, args.runs))
+        print('  {:<20} {:>10} {:>10} {:>10}'.format('', 'no index', 'pre-v8', 'composite'))
+        for (name, none), (_, before), (_, after) in zip(*results):
+            print('  {:<20} {:>10.1f} {:>10.1f} {:>10.1f}'.format(name, none * 1000, before * 1000, after * 1000))
+    finally:
+        model.drop_table(fail_silently=True)
+        db.close()
+        if scratch:
+            os.remove(scratch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Run from anywhere in the checkout.
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, root)
+
+# Benchmark rows get keys real rows are all but certain not to have, and
+# are deleted afterwards.
+first_encounter_id = -2 ** 62
+
+
+def pokemon_rows(count):
+    now = datetime.utcnow()
+    rows = {}
+    for i in range(count):
+        encounter_id = first_encounter_id + i
+        rows[encounter_id] = {
+            'encounter_id': encounter_id,
+            'spawnpoint_id': 'bench%x' % random.getrandbits(40),
+            'pokemon_id': random.randint(1, 151),
+            'latitude': random.uniform(-60, 60),
+            'longitude': random.uniform(-180, 180),
+            'disappear_time': now + timedelta(seconds=random.randint(0, 900))
+        }
+    return rows
+
+
+def scannedlocation_rows(count):
+    # Latitudes past the poles, so they can't clash with real scans.
+    now = datetime.utcnow()
+    rows = {}
+    for i in range(count):
+        key = (1000.0 + i, random.uniform(-180, 180))
+        rows[key] = {'latitude': key[0], 'longitude': key[1], 'last_modified': now}
+    return rows
+
+
+def gympokemon_rows(count):
+    rows = {}
+    for i in range(count):
+        uid = 'bench%d' % i
+        rows[uid] = {
+            'pokemon_uid': uid,
+            'pokemon_id': random.randint(1, 151),
+            'cp': random.randint(10, 3000),
+            'trainer_name': 'bench',
+            'num_upgrades': 0,
+            'move_1': random.randint(1, 250),
+            'move_2': random.randint(1, 250),
+            'height': random.random(),
+            'weight': random.random() * 100,
+            'stamina': 100,
+            'stamina_max': 100,
+            'cp_multiplier': random.random(),
+            'additional_cp_multiplier': 0.0,
+            'iv_defense': random.randint(0, 15),
+            'iv_stamina': random.randint(0, 15),
+            'iv_attack': random.randint(0, 15),
+            'last_seen': datetime.utcnow()
+        }
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time bulk_upsert in rows/sec per model. Arguments it doesn\'t know, e.g. '
+                    '--db-type mysql --db-host ..., go to the map\'s own parser to pick the database; '
+                    'without any it uses a scratch SQLite file.')
+    parser.add_argument('-n', '--rows', help='rows per model', type=int, default=20000)
+    parser.add_argument('-r', '--runs', help='runs per model, the best one counts', type=int, default=3)
+    parser.add_argument('-s', '--seed', help='random seed', type=int, default=1)
+    args, pogom_args = parser.parse_known_args()
+
+    scratch = None
+    if '--db-type' not in pogom_args and '-D' not in pogom_args and '--db' not in pogom_args:
+        scratch = tempfile.mktemp(suffix='.db')
+        pogom_args += ['-D', scratch]
+    # The map's parser needs these, but the benchmark doesn't use them.
+    sys.argv = [sys.argv[0], '-os', '-l', '0,0', '-k', 'bench'] + pogom_args
+
+    from pogom import config
+    from pogom.app import Pogom
+    from pogom.models import (init_database, create_tables, bulk_upsert, run_with_retries,
+                              Pokemon, ScannedLocation, GymPokemon)
+    config['ROOT_PATH'] = root
+    db = init_database(Pogom(__name__))
+    create_tables(db)
+    db.connect()
+
+    random.seed(args.seed)
+    benchmarks = [(Pokemon, pokemon_rows, Pokemon.encounter_id.between(first_encounter_id,
+                                                                       first_encounter_id + args.rows - 1)),
+                  (ScannedLocation, scannedlocation_rows, ScannedLocation.latitude >= 1000.0),
+                  (GymPokemon, gympokemon_rows, GymPokemon.pokemon_uid.startswith('bench'))]
+    try:
+        for model, rows, benchmark_rows in benchmarks:
+            data = rows(args.rows)
+            inserts = []
+            updates = []
+            for run in range(args.runs):
+                model.delete().where(benchmark_rows).execute()
+                start = time.time()
+                run_with_retries(bulk_upsert, model, data)
+                inserts.append(time.time() - start)
+                start = time.time()
+                run_with_retries(bulk_upsert, model, data)
+                updates.append(time.time() - start)
+            print('{:<16} {:>8.0f} rows/s inserted, {:>8.0f} rows/s updated ({} rows, {} columns)'.format(
+                model.__name__, args.rows / min(inserts), args.rows / min(updates),
+                args.rows, len(data.values()[0])))
+    finally:
+        for model, rows, benchmark_rows in benchmarks:
+            model.delete().where(benchmark_rows).execute()
+        db.close()
+        if scratch:
+            os.remove(scratch)
+
+
+if __name__ == '__main__':
+    main()
@@ -90,7 +90,7 @@ def makeWildPokemon(location):
         ll = LatLng.from_degrees(coords[0], coords[1])
         cellId = CellId.from_lat_lng(ll).parent(20).to_token()
         pokes.append({
-            'encounter_id': 'pkm' + seedid + str(i),
+            'encounter_id': getrandbits(64),
             'last_modified_timestamp_ms': int((time() - 10) * 1000),
             'latitude': coords[0],
             'longitude': coords[1],
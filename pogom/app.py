@@ -1,10 +1,10 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import calendar
 import logging
+import zlib
 
-from flask import Flask, abort, jsonify, render_template, request
+from flask import Flask, Response, abort, jsonify, render_template, request, stream_with_context
 from flask.json import JSONEncoder
 from flask_compress import Compress
 from datetime import datetime
@@ -14,17 +14,29 @@ from datetime import timedelta
 from collections import OrderedDict
 
 from . import config
-from .models import Pokemon, Gym, Pokestop, ScannedLocation, MainWorker, WorkerStatus
+from .models import Pokemon, Gym, Pokestop, ScannedLocation, MainWorker, WorkerStatus, change_journal, \
+    live_pokemon, tile_cache, db_routing, close_read_replicas, read_from_primary
 from .utils import now
 log = logging.getLogger(__name__)
 compress = Compress()
 
+EPOCH = datetime(1970, 1, 1)
+
+# Fields sent per row in columnar responses. Pokemon names, rarities and
+# types are sent once per species instead.
+POKEMON_COLUMNS = ('encounter_id', 'spawnpoint_id', 'pokemon_id',
+                   'latitude', 'longitude', 'disappear_time')
+POKESTOP_COLUMNS = ('pokestop_id', 'enabled', 'latitude', 'longitude',
+                    'last_modified', 'lure_expiration', 'active_fort_modifier')
+
 
 class Pogom(Flask):
     def __init__(self, import_name, **kwargs):
         super(Pogom, self).__init__(import_name, **kwargs)
         compress.init_app(self)
         self.json_encoder = CustomJSONEncoder
+        self.before_request(self.route_reads)
+        self.teardown_request(self.end_reads)
         self.route("/", methods=['GET'])(self.fullmap)
         self.route("/raw_data", methods=['GET'])(self.raw_data)
         self.route("/loc", methods=['GET'])(self.loc)
@@ -36,6 +48,17 @@ class Pogom(Flask):
         self.route("/status", methods=['GET'])(self.get_status)
         self.route("/status", methods=['POST'])(self.post_status)
 
+    def route_reads(self):
+        # The map, stats and status pages read from the replicas, if there
+        # are any. Responses that carry a change token don't: the journal
+        # can be ahead of a lagging replica, and a row it already covers
+        # would never reach the client.
+        db_routing.replica = not (change_journal.enabled and request.path == '/raw_data')
+
+    def end_reads(self, exception):
+        db_routing.replica = False
+        close_read_replicas()
+
     def set_search_control(self, control):
         self.search_control = control
 
@@ -93,23 +116,111 @@ class Pogom(Flask):
         swLng = request.args.get('swLng')
         neLat = request.args.get('neLat')
         neLng = request.args.get('neLng')
+
+        # Unbounded requests can cover the whole database, so their rows are
+        # written out as they are read instead of being built up in memory.
+        stream = (request.args.get('stream', 'false') == 'true' or
+                  None in (swLat, swLng, neLat, neLng))
+        # Columnar responses are already compact and built in one go.
+        columnar = request.args.get('format') == 'columnar'
+        if columnar:
+            stream = False
+
+        # Delta mode: a client passing back the token from its previous
+        # response only gets what was written since then. The token is taken
+        # before querying, so rows written meanwhile are sent again next time.
+        changed, since = {}, None
+        if change_journal.enabled:
+            d['token'] = change_journal.token()
+            if request.args.get('since'):
+                delta = change_journal.changed_since(request.args.get('since'))
+                if delta is not None:
+                    changed, since = delta
+                    d['delta'] = True
+                    d['expired'] = {}
+
+        # Plain viewport queries can share results through the tile cache.
+        tiled = not stream and since is None
+
         if request.args.get('pokemon', 'true') == 'true':
+            encounter_ids = changed.get('pokemon', set()) if since else None
+            ids = None
             if request.args.get('ids'):
                 ids = [int(x) for x in request.args.get('ids').split(',')]
+            pokemons = None
+            # The live index is already in memory.
+            if tiled and not live_pokemon.enabled:
+                pokemons = from_tiles('pokemon', swLat, swLng, neLat, neLng,
+                                      Pokemon.get_active)
+                if pokemons is not None:
+                    # A tile is kept for its TTL even after some of its
+                    # Pokemon have disappeared.
+                    utcnow = datetime.utcnow()
+                    pokemons = [p for p in pokemons if p['disappear_time'] > utcnow and
+                                (ids is None or p['pokemon_id'] in ids)]
+
+            if pokemons is not None:
+                d['pokemons'] = pokemons
+            elif stream:
+                d['pokemons'] = Pokemon.iter_active(swLat, swLng, neLat, neLng,
+                                                    ids, encounter_ids)
+            elif ids is not None:
                 d['pokemons'] = Pokemon.get_active_by_id(ids, swLat, swLng,
-                                                         neLat, neLng)
+                                                         neLat, neLng,
+                                                         encounter_ids)
             else:
-                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng)
+                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng,
+                                                   encounter_ids)
+            if since:
+                d['expired']['pokemons'] = Pokemon.get_expired(since, swLat, swLng,
+                                                               neLat, neLng)
 
         if request.args.get('pokestops', 'true') == 'true':
-            d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng)
+            pokestop_ids = changed.get('pokestop', set()) if since else None
+            pokestops = None
+            if tiled:
+                pokestops = from_tiles('pokestop', swLat, swLng, neLat, neLng,
+                                       Pokestop.get_stops)
+
+            if pokestops is not None:
+                d['pokestops'] = pokestops
+            elif stream:
+                d['pokestops'] = Pokestop.iter_stops(swLat, swLng, neLat, neLng,
+                                                     pokestop_ids)
+            else:
+                d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng,
+                                                    pokestop_ids)
 
         if request.args.get('gyms', 'true') == 'true':
-            d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng)
+            gym_ids = changed.get('gym', set()) if since else None
+            gyms = None
+            if tiled:
+                gyms = from_tiles('gym', swLat, swLng, neLat, neLng,
+                                  lambda *bounds: Gym.get_gyms(*bounds).values())
+
+            if gyms is not None:
+                d['gyms'] = dict((g['gym_id'], g) for g in gyms)
+            elif stream:
+                d['gyms'] = JSONObjectItems((g['gym_id'], g) for g in
+                                            Gym.iter_gyms(swLat, swLng, neLat, neLng, gym_ids))
+            else:
+                d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng, gym_ids)
 
         if request.args.get('scanned', 'true') == 'true':
-            d['scanned'] = ScannedLocation.get_recent(swLat, swLng, neLat,
-                                                      neLng)
+            locations = changed.get('scannedlocation', set()) if since else None
+            scanned = None
+            if tiled:
+                scanned = from_tiles('scannedlocation', swLat, swLng, neLat, neLng,
+                                     ScannedLocation.get_recent)
+
+            if scanned is not None:
+                d['scanned'] = sorted(scanned, key=lambda s: s['last_modified'])
+            elif stream:
+                d['scanned'] = ScannedLocation.iter_recent(swLat, swLng, neLat,
+                                                           neLng, locations)
+            else:
+                d['scanned'] = ScannedLocation.get_recent(swLat, swLng, neLat,
+                                                          neLng, locations)
 
         selected_duration = None
 
@@ -131,7 +242,17 @@ class Pogom(Flask):
                                                                                 selected_duration)
 
         if request.args.get('spawnpoints', 'false') == 'true':
-            d['spawnpoints'] = Pokemon.get_spawnpoints(swLat, swLng, neLat, neLng)
+            if stream:
+                d['spawnpoints'] = Pokemon.iter_spawnpoints(swLat, swLng, neLat, neLng)
+            else:
+                d['spawnpoints'] = Pokemon.get_spawnpoints(swLat, swLng, neLat, neLng)
+
+        if columnar:
+            if 'pokemons' in d:
+                d['species'] = get_species_map(d['pokemons'])
+                d['pokemons'] = to_columns(d['pokemons'], POKEMON_COLUMNS)
+            if 'pokestops' in d:
+                d['pokestops'] = to_columns(d['pokestops'], POKESTOP_COLUMNS)
 
         if request.args.get('status', 'false') == 'true':
             args = get_args()
@@ -142,8 +263,22 @@ class Pogom(Flask):
                 d['main_workers'] = MainWorker.get_all()
                 d['workers'] = WorkerStatus.get_all()
 
+        if stream:
+            return self.stream_json(d)
+
         return jsonify(d)
 
+    def stream_json(self, d):
+        chunks = stream_with_context(iter_json(d))
+        headers = {}
+        # flask_compress would buffer the whole body to gzip it, so compress
+        # as we go instead; it leaves responses with an encoding set alone.
+        if 'gzip' in request.headers.get('Accept-Encoding', '').lower():
+            chunks = iter_gzip(chunks, self.config['COMPRESS_LEVEL'])
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+        return Response(chunks, mimetype='application/json', headers=headers)
+
     def loc(self):
         d = {}
         d['lat'] = self.current_location[0]
@@ -279,18 +414,116 @@ class Pogom(Flask):
         return jsonify(d)
 
 
+def to_millis(dt):
+    if dt.utcoffset() is not None:
+        dt = (dt - dt.utcoffset()).replace(tzinfo=None)
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+
+def from_tiles(table, swLat, swLng, neLat, neLng, load):
+    # Rows from the shared tile cache, or None when it can't answer.
+    args = get_args()
+    # Rows are returned in GCJ coordinates in China, which don't line up
+    # with the tiles they were queried by.
+    if not tile_cache.enabled or args.china:
+        return None
+
+    # Tiles are shared and kept until the next write invalidates them, so
+    # they mustn't be loaded from a replica that hasn't caught up with it.
+    def load_from_primary(*bounds):
+        with read_from_primary():
+            return load(*bounds)
+
+    return tile_cache.get(table, swLat, swLng, neLat, neLng, load_from_primary)
+
+
+def to_columns(rows, fields):
+    # {field: [value per row]}, with datetimes as epoch milliseconds.
+    columns = dict((field, []) for field in fields)
+    for row in rows:
+        for field in fields:
+            value = row[field]
+            if isinstance(value, datetime):
+                value = to_millis(value)
+            columns[field].append(value)
+    return columns
+
+
+def get_species_map(pokemons):
+    species = {}
+    for p in pokemons:
+        if p['pokemon_id'] not in species:
+            species[p['pokemon_id']] = {
+                'pokemon_name': p['pokemon_name'],
+                'pokemon_rarity': p['pokemon_rarity'],
+                'pokemon_types': p['pokemon_types']
+            }
+    return species
+
+
+class JSONObjectItems(object):
+    # (key, value) pairs that iter_json writes out as a JSON object, one
+    # pair at a time.
+
+    def __init__(self, items):
+        self.items = items
+
+
+def iter_json(d, chunk_size=64 * 1024):
+    # Yields d as JSON. Lists, generators and JSONObjectItems are written
+    # one row at a time and flat rows get their datetimes converted up
+    # front, so the encoder never has to call back into default() for them.
+    encode = CustomJSONEncoder(separators=(',', ':')).encode
+    buf = []
+    size = 0
+    buf.append('{')
+    for i, (key, value) in enumerate(d.items()):
+        buf.append('{}{}:'.format(',' if i else '', encode(key)))
+        if isinstance(value, JSONObjectItems):
+            rows = value.items
+            buf.append('{')
+        elif isinstance(value, dict) or not hasattr(value, '__iter__'):
+            buf.append(encode(value))
+            continue
+        else:
+            rows = ((None, row) for row in value)
+            buf.append('[')
+
+        for j, (row_key, row) in enumerate(rows):
+            if isinstance(row, dict):
+                for k, v in row.items():
+                    if isinstance(v, datetime):
+                        row[k] = to_millis(v)
+            row = encode(row)
+            if row_key is not None:
+                row = '{}:{}'.format(encode(row_key), row)
+            buf.append(',' + row if j else row)
+            size += len(row)
+            if size >= chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        buf.append('}' if isinstance(value, JSONObjectItems) else ']')
+    buf.append('}')
+    yield ''.join(buf)
+
+
+def iter_gzip(chunks, level):
+    z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = z.compress(chunk)
+        if data:
+            yield data
+    yield z.flush()
+
+
 class CustomJSONEncoder(JSONEncoder):
 
     def default(self, obj):
         try:
             if isinstance(obj, datetime):
-                if obj.utcoffset() is not None:
-                    obj = obj - obj.utcoffset()
-                millis = int(
-                    calendar.timegm(obj.timetuple()) * 1000 +
-                    obj.microsecond / 1000
-                )
-                return millis
+                return to_millis(obj)
             iterable = iter(obj)
         except TypeError:
             pass
@@ -0,0 +1,411 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+In-memory structures shared between the search workers, the db updaters and
+the web handlers. The database stays the durable record; these exist so the
+hot paths don't have to go back to it on every request or scan.
+'''
+
+import heapq
+import itertools
+import logging
+import math
+import time
+
+from cachetools import TTLCache
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+
+# Grid index of the Pokemon that are still visible, keyed by encounter id and
+# evicted once their disappear_time has passed.
+class ActivePokemonStore(object):
+
+    def __init__(self, cell_size=0.01):
+        # ~1.1km cells; a typical map viewport covers a few dozen of them.
+        self.cell_size = cell_size
+        self.enabled = False
+        self.lock = Lock()
+        self.pokemon = {}
+        self.cells = {}
+        self.by_id = {}
+        self.expiry = []
+
+    def __len__(self):
+        return len(self.pokemon)
+
+    def _cell(self, lat, lng):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lng / self.cell_size)))
+
+    def _remove(self, encounter_id):
+        p = self.pokemon.pop(encounter_id)
+        cell = self._cell(p['latitude'], p['longitude'])
+        self.cells[cell].discard(encounter_id)
+        if not self.cells[cell]:
+            del self.cells[cell]
+        self.by_id[p['pokemon_id']].discard(encounter_id)
+        if not self.by_id[p['pokemon_id']]:
+            del self.by_id[p['pokemon_id']]
+
+    def _evict(self, now):
+        while self.expiry and self.expiry[0][0] <= now:
+            disappear_time, encounter_id = heapq.heappop(self.expiry)
+            p = self.pokemon.get(encounter_id)
+            # Skip heap entries left behind when a sighting was updated.
+            if p is not None and p['disappear_time'] == disappear_time:
+                self._remove(encounter_id)
+
+    def add(self, rows):
+        now = datetime.utcnow()
+        with self.lock:
+            for row in rows:
+                if row['disappear_time'] <= now:
+                    continue
+                encounter_id = row['encounter_id']
+                if encounter_id in self.pokemon:
+                    self._remove(encounter_id)
+                p = dict(row)
+                self.pokemon[encounter_id] = p
+                self.cells.setdefault(self._cell(p['latitude'], p['longitude']), set()).add(encounter_id)
+                self.by_id.setdefault(p['pokemon_id'], set()).add(encounter_id)
+                heapq.heappush(self.expiry, (p['disappear_time'], encounter_id))
+            self._evict(now)
+
+    def get_active(self, swLat, swLng, neLat, neLng, ids=None):
+        now = datetime.utcnow()
+        with self.lock:
+            self._evict(now)
+
+            if swLat is None or swLng is None or neLat is None or neLng is None:
+                bounds = None
+            else:
+                bounds = (float(swLat), float(swLng), float(neLat), float(neLng))
+
+            if ids is not None:
+                candidates = itertools.chain.from_iterable(self.by_id.get(i, ()) for i in set(ids))
+            elif bounds is None:
+                candidates = self.pokemon.keys()
+            else:
+                sw = self._cell(bounds[0], bounds[1])
+                ne = self._cell(bounds[2], bounds[3])
+                num_cells = (ne[0] - sw[0] + 1) * (ne[1] - sw[1] + 1)
+                if num_cells > len(self.cells):
+                    # Zoomed far out; walking the occupied cells is cheaper.
+                    candidates = self.pokemon.keys()
+                else:
+                    candidates = itertools.chain.from_iterable(
+                        self.cells.get((x, y), ())
+                        for x in range(sw[0], ne[0] + 1)
+                        for y in range(sw[1], ne[1] + 1))
+
+            pokemons = []
+            for encounter_id in candidates:
+                p = self.pokemon[encounter_id]
+                if bounds is not None and not (bounds[0] <= p['latitude'] <= bounds[2] and
+                                               bounds[1] <= p['longitude'] <= bounds[3]):
+                    continue
+                pokemons.append(dict(p))
+
+        return pokemons
+
+
+# Remembers which rows were written recently, so map clients can ask for only
+# what changed since their last poll. Tokens embed a per-process epoch, so a
+# token handed out before a restart is never mistaken for a current one.
+class ChangeJournal(object):
+
+    def __init__(self, max_entries=100000):
+        self.enabled = False
+        self.epoch = '{:x}'.format(int(time.time()))
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.seq = 0
+        # Tokens older than this have lost entries to trimming.
+        self.oldest_seq = 0
+        self.changes = OrderedDict()
+
+    def record(self, table, keys):
+        with self.lock:
+            self.seq += 1
+            for key in keys:
+                self.changes.pop((table, key), None)
+                self.changes[(table, key)] = self.seq
+            while len(self.changes) > self.max_entries:
+                self.oldest_seq = self.changes.popitem(last=False)[1]
+
+    def token(self):
+        # The timestamp lets readers ask the database for time-based changes
+        # (expired Pokemon) that aren't journaled.
+        return '{}-{}-{}'.format(self.epoch, self.seq, int(time.time() * 1000))
+
+    def changed_since(self, token):
+        # Returns ({table: set(keys)}, datetime of the token), or None when
+        # the token can't be answered and the client needs a full refresh.
+        try:
+            epoch, seq, millis = token.split('-')
+            seq = int(seq)
+            since = datetime.utcfromtimestamp(int(millis) / 1000.0)
+        except (AttributeError, ValueError):
+            return None
+        with self.lock:
+            if epoch != self.epoch or seq < self.oldest_seq or seq > self.seq:
+                return None
+            changed = {}
+            # Entries are kept in write order; walk back from the newest.
+            for entry in reversed(self.changes):
+                if self.changes[entry] <= seq:
+                    break
+                changed.setdefault(entry[0], set()).add(entry[1])
+        return changed, since
+
+
+# Gym rosters (name and defending Pokemon) by gym_id. parse_gyms invalidates
+# the gyms it writes; the TTL bounds staleness when another instance is the
+# one scanning gym details.
+class GymRosterCache(object):
+
+    def __init__(self, maxsize=20000, ttl=60 * 5):
+        self.lock = Lock()
+        self.rosters = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Bumped by every invalidation, so a load that raced with one isn't
+        # kept (see TileCache).
+        self.generations = {}
+
+    def get(self, gym_ids):
+        # Returns ({gym_id: roster} of the cached ones, generations to pass
+        # to update() along with the rosters loaded for the rest).
+        rosters = {}
+        generations = {}
+        with self.lock:
+            for gym_id in gym_ids:
+                roster = self.rosters.get(gym_id)
+                if roster is not None:
+                    rosters[gym_id] = roster
+                else:
+                    generations[gym_id] = self.generations.get(gym_id, 0)
+        return rosters, generations
+
+    def update(self, rosters, generations):
+        with self.lock:
+            for gym_id, roster in rosters.items():
+                # Invalidated while loading: the load may predate the write.
+                if self.generations.get(gym_id, 0) == generations.get(gym_id):
+                    self.rosters[gym_id] = roster
+
+    def invalidate(self, gym_ids):
+        with self.lock:
+            for gym_id in gym_ids:
+                self.rosters.pop(gym_id, None)
+                self.generations[gym_id] = self.generations.get(gym_id, 0) + 1
+
+
+# Query results per fixed grid tile and table, so clients looking at the same
+# area share one query per tile instead of one per arbitrary viewport.
+# Writes invalidate the tiles they land in; the TTLs bound staleness of
+# anything written by another instance.
+class TileCache(object):
+
+    def __init__(self, tile_size=0.02, max_tiles=64, maxsize=5000, ttls=None):
+        # ~2.2km tiles; a city-wide viewport needs a few dozen of them.
+        self.tile_size = tile_size
+        # Viewports needing more tiles than this go straight to the database.
+        self.max_tiles = max_tiles
+        self.enabled = False
+        self.lock = Lock()
+        self.tiles = {}
+        # Bumped by every invalidation, per tile and per table (for clear()),
+        # so a load that raced with one isn't kept.
+        self.generations = {}
+        self.cleared = {}
+        for table, ttl in (ttls or {}).items():
+            self.tiles[table] = TTLCache(maxsize=maxsize, ttl=ttl)
+            self.generations[table] = {}
+            self.cleared[table] = 0
+
+    def _tile(self, lat, lng):
+        return (int(math.floor(lat / self.tile_size)),
+                int(math.floor(lng / self.tile_size)))
+
+    def get(self, table, swLat, swLng, neLat, neLng, load):
+        # Returns the rows in the viewport, loading missing tiles with
+        # load(swLat, swLng, neLat, neLng). None if the viewport is too big
+        # to go through the cache.
+        swLat, swLng, neLat, neLng = float(swLat), float(swLng), float(neLat), float(neLng)
+        sw = self._tile(swLat, swLng)
+        ne = self._tile(neLat, neLng)
+        if (ne[0] - sw[0] + 1) * (ne[1] - sw[1] + 1) > self.max_tiles:
+            return None
+
+        rows = []
+        for x in range(sw[0], ne[0] + 1):
+            for y in range(sw[1], ne[1] + 1):
+                with self.lock:
+                    tile = self.tiles[table].get((x, y))
+                    generation = self._generation(table, (x, y))
+                if tile is None:
+                    # Loaded outside the lock; two requests missing the same
+                    # tile both query it, which is harmless.
+                    # With a small margin, so rounding at the edges can't
+                    # lose rows that _tile() puts in this tile.
+                    tile = load(x * self.tile_size - 1e-9, y * self.tile_size - 1e-9,
+                                (x + 1) * self.tile_size + 1e-9, (y + 1) * self.tile_size + 1e-9)
+                    with self.lock:
+                        # Invalidated while loading: the load may predate the
+                        # write, so only this request uses it.
+                        if self._generation(table, (x, y)) == generation:
+                            self.tiles[table][(x, y)] = tile
+                for row in tile:
+                    # Rows on a shared edge are in both tiles; each belongs
+                    # to the tile it falls into.
+                    if (self._tile(row['latitude'], row['longitude']) == (x, y) and
+                            swLat <= row['latitude'] <= neLat and
+                            swLng <= row['longitude'] <= neLng):
+                        rows.append(dict(row))
+        return rows
+
+    def _generation(self, table, tile):
+        return self.cleared[table], self.generations[table].get(tile, 0)
+
+    def invalidate(self, table, points):
+        # Drops the tiles containing any of the (lat, lng) points.
+        with self.lock:
+            if table not in self.tiles:
+                return
+            generations = self.generations[table]
+            for lat, lng in points:
+                tile = self._tile(lat, lng)
+                self.tiles[table].pop(tile, None)
+                generations[tile] = generations.get(tile, 0) + 1
+
+    def clear(self, table):
+        with self.lock:
+            if table in self.tiles:
+                self.tiles[table].clear()
+                self.cleared[table] += 1
+
+
+# Last written state of each fort, so forts that look the same as last time
+# aren't queued for writing again. Entries expire, so unchanged forts are
+# still rewritten now and then (which refreshes Gym.last_scanned).
+class FortFingerprints(object):
+
+    def __init__(self, maxsize=200000, ttl=60 * 10):
+        self.lock = Lock()
+        self.fingerprints = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def changed(self, fort_id, fingerprint):
+        with self.lock:
+            return self.fingerprints.get(fort_id) != fingerprint
+
+    def update(self, items):
+        # items: (fort_id, fingerprint) pairs of rows that were written.
+        with self.lock:
+            for fort_id, fingerprint in items:
+                self.fingerprints[fort_id] = fingerprint
+
+
+# Encounter ids parse_map has already handled, until they disappear. Lets
+# overlapping scans skip the Pokemon they have already queued.
+class SeenEncounters(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.seen = {}
+        self.expiry = []
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, encounter_id, disappear_time):
+        # True if this is a new sighting: an id not seen yet, or seen with
+        # another disappear_time (e.g. the real one after a guessed one).
+        now = datetime.utcnow()
+        with self.lock:
+            while self.expiry and self.expiry[0][0] <= now:
+                expires, old_id = heapq.heappop(self.expiry)
+                if self.seen.get(old_id) == expires:
+                    del self.seen[old_id]
+
+            if self.seen.get(encounter_id) == disappear_time:
+                self.hits += 1
+                return False
+            self.misses += 1
+            self.seen[encounter_id] = disappear_time
+            heapq.heappush(self.expiry, (disappear_time, encounter_id))
+            return True
+
+    def discard(self, encounter_ids):
+        # Forgets sightings whose write failed, so the next scan queues them
+        # again. Their expiry entries are skipped once they come up.
+        with self.lock:
+            for encounter_id in encounter_ids:
+                self.seen.pop(encounter_id, None)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+
+# Keys of work that was handed off but hasn't completed yet.
+class PendingKeys(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.keys = set()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.keys
+
+    def add(self, keys):
+        with self.lock:
+            self.keys.update(keys)
+
+    def discard(self, keys):
+        with self.lock:
+            self.keys.difference_update(keys)
+
+
+# When each gym's details were last written, so search workers can tell
+# which gyms need a details request without asking the database each scan.
+class GymFreshness(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.warmed = False
+        self.last_scanned = {}
+
+    def get(self, gym_ids):
+        with self.lock:
+            return dict((gym_id, self.last_scanned[gym_id])
+                        for gym_id in gym_ids if gym_id in self.last_scanned)
+
+    def update(self, items, warmed=False):
+        # items: (gym_id, last_scanned) pairs.
+        with self.lock:
+            for gym_id, last_scanned in items:
+                self.last_scanned[gym_id] = max(last_scanned,
+                                                self.last_scanned.get(gym_id, last_scanned))
+            self.warmed = self.warmed or warmed
+
+
+# Rows collected between periodic writes, keyed so that a row added again
+# before the next write replaces the earlier one.
+class RowBuffer(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.rows = {}
+
+    def add(self, key, row):
+        with self.lock:
+            self.rows[key] = row
+
+    def drain(self):
+        with self.lock:
+            rows, self.rows = self.rows, {}
+        return rows
@@ -2,41 +2,176 @@
 # -*- coding: utf-8 -*-
 import logging
 import itertools
+import gzip
+import json
+import os
 import calendar
 import sys
 import gc
+import operator
+import re
 import time
-import geopy
+from contextlib import contextmanager
 from peewee import SqliteDatabase, InsertQuery, \
-    IntegerField, CharField, DoubleField, BooleanField, \
-    DateTimeField, fn, DeleteQuery, CompositeKey, FloatField, SQL, TextField
+    IntegerField, BigIntegerField, CharField, DoubleField, BooleanField, \
+    DateTimeField, fn, DeleteQuery, CompositeKey, FloatField, SQL, TextField, \
+    IntegrityError
 from playhouse.flask_utils import FlaskDB
 from playhouse.pool import PooledMySQLDatabase
 from playhouse.shortcuts import RetryOperationalError
 from playhouse.migrate import migrate, MySQLMigrator, SqliteMigrator
 from datetime import datetime, timedelta
-from base64 import b64encode
+from base64 import b64encode, b64decode
+from threading import Event, Lock, local
+from queue import Empty
 from cachetools import TTLCache
 from cachetools import cached
 
 from . import config
-from .utils import get_pokemon_name, get_pokemon_rarity, get_pokemon_types, get_args
-from .transform import transform_from_wgs_to_gcj, get_new_coords
+from .utils import get_pokemon_species, get_args
+from .transform import transform_from_wgs_to_gcj, get_new_coords, filter_within
 from .customLog import printPokemon
+from .cache import ActivePokemonStore, ChangeJournal, GymRosterCache, TileCache, FortFingerprints, \
+    SeenEncounters, PendingKeys, GymFreshness, \
+    RowBuffer
 
 log = logging.getLogger(__name__)
 
 args = get_args()
 flaskDb = FlaskDB()
 cache = TTLCache(maxsize=100, ttl=60 * 5)
-
-db_schema_version = 7
+live_pokemon = ActivePokemonStore()
+change_journal = ChangeJournal()
+gym_rosters = GymRosterCache()
+tile_cache = TileCache(ttls={'pokemon': 10, 'pokestop': 60, 'gym': 60, 'scannedlocation': 10})
+fort_fingerprints = FortFingerprints()
+seen_encounters = SeenEncounters()
+pending_gym_details = PendingKeys()
+gym_freshness = GymFreshness()
+# Filled by parse_map; written out every few seconds by the search overseer.
+scanned_locations = RowBuffer()
+
+db_schema_version = 9
+
+# bulk_upsert writes rows in batches of about this many values (rows times
+# columns); run_with_retries gives up on a write after this many tries.
+db_batch_values = 20000
+db_upsert_attempts = 5
+# Largest statement PyMySQL may build, from the server's max_allowed_packet.
+max_stmt_length = []
+
+# db_updater merges queued rows per model and writes them once this many
+# have built up, or once the first of them has waited this long.
+db_flush_rows = 500
+db_flush_seconds = 1.0
+
+# Kept outside the Pokemon model so database_migrate can build them on
+# existing tables.
+pokemon_indexes = ((('disappear_time', 'latitude', 'longitude'), False),
+                   (('pokemon_id', 'disappear_time', 'latitude', 'longitude', 'spawnpoint_id'), False),
+                   (('spawnpoint_id', 'pokemon_id', 'disappear_time'), False))
+
+# Cleanup runs in chunks of this many rows, for at most db_clean_budget
+# seconds a minute, pausing db_clean_pause seconds after each chunk.
+db_clean_chunk = 1000
+db_clean_budget = 10.0
+db_clean_pause = 0.1
+
+# With --db-daily-pokemon, the models of the daily Pokemon tables by day, and
+# [time read, days, legacy] of the tables that exist, legacy telling whether
+# the pokemon table from before still has rows.
+partition_models = {}
+partition_days = []
+partition_lock = Lock()
 
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
     pass
 
 
+# Threads that may write in --db-sqlite-wal mode: the one that set up the
+# database and the db updater. Everything else gets read-only connections
+# and hands its writes to the db updater as a DbTask.
+sqlite_writer = local()
+
+# With --db-read-host, the replicas that threads with db_routing.replica set
+# read from, taking turns.
+read_replicas = []
+read_replica_turn = itertools.count()
+db_routing = local()
+
+# An INTEGER primary key is the rowid itself, so SQLite doesn't need a
+# separate index for the encounter ids.
+sqlite_fields = {'bigint': 'INTEGER'}
+
+
+class WalSqliteDatabase(SqliteDatabase):
+
+    def _add_conn_hooks(self, conn):
+        super(WalSqliteDatabase, self)._add_conn_hooks(conn)
+        if not getattr(sqlite_writer, 'enabled', False):
+            conn.execute('PRAGMA query_only = 1')
+
+
+# Database work to be run by the db updater thread, in queue order with the
+# upserts around it. Queued as (DbTask, task).
+class DbTask(object):
+
+    def __init__(self, func, args=(), callback=None):
+        self.func = func
+        self.args = args
+        # Called with the task once it ran, from the db updater thread.
+        self.callback = callback
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+            if self.callback is not None:
+                self.callback(self)
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def run_as_writer(q, func, *func_args):
+    # Runs func on the writer connection when other threads may not write,
+    # waiting for it to finish; otherwise runs it right here.
+    if not args.db_sqlite_wal:
+        return func(*func_args)
+    task = DbTask(func, func_args)
+    q.put((DbTask, task))
+    return task.wait()
+
+
+def run_with_retries(func, *func_args):
+    # Runs func in a transaction of its own, running all of it again if it
+    # fails (e.g. MySQL rolled it back to break a deadlock). Waits between
+    # tries outside the transaction, so no locks are held meanwhile. Only
+    # for whole units of work: inside another transaction, the retry would
+    # run in a savepoint of a transaction that may be gone already.
+    for attempt in range(db_upsert_attempts):
+        try:
+            with flaskDb.database.atomic():
+                return func(*func_args)
+        except Exception as e:
+            if attempt + 1 == db_upsert_attempts:
+                log.error('Failed to write to the database %d times: %s', db_upsert_attempts, e)
+                raise
+            delay = 0.5 * 2 ** attempt
+            log.warning('%s... Retrying in %.1fs', e, delay)
+            time.sleep(delay)
+
+
 def init_database(app):
     if args.db_type == 'mysql':
         log.info('Connecting to MySQL database on %s:%i', args.db_host, args.db_port)
@@ -51,9 +186,31 @@ def init_database(app):
             port=args.db_port,
             max_connections=connections,
             stale_timeout=300)
+
+        for read_host in args.db_read_host:
+            host, _, port = read_host.partition(':')
+            log.info('Reading from MySQL replica on %s:%i', host, int(port or args.db_port))
+            read_replicas.append(MyRetryDB(
+                args.db_name,
+                user=args.db_user,
+                password=args.db_pass,
+                host=host,
+                port=int(port or args.db_port),
+                max_connections=args.db_max_connections,
+                stale_timeout=300))
+    elif args.db_sqlite_wal:
+        log.info('Connecting to local SQLite database in WAL mode')
+        # Readers don't block the writer (or each other) in WAL mode; the
+        # writer only waits on checkpoints, so give it a moment instead of
+        # failing right away.
+        sqlite_writer.enabled = True
+        db = WalSqliteDatabase(args.db, fields=sqlite_fields,
+                               pragmas=[('journal_mode', 'wal'),
+                                        ('synchronous', 'normal'),
+                                        ('busy_timeout', 5000)])
     else:
         log.info('Connecting to local SQLite database')
-        db = SqliteDatabase(args.db)
+        db = SqliteDatabase(args.db, fields=sqlite_fields)
 
     app.config['DATABASE'] = db
     flaskDb.init_app(app)
@@ -61,8 +218,33 @@ def init_database(app):
     return db
 
 
+@contextmanager
+def read_from_primary():
+    # For reads that can't wait for the replicas to catch up.
+    replica = getattr(db_routing, 'replica', False)
+    db_routing.replica = False
+    try:
+        yield
+    finally:
+        db_routing.replica = replica
+
+
+def close_read_replicas():
+    # Hands this thread's replica connections back to their pools.
+    for db in read_replicas:
+        if not db.is_closed():
+            db.close()
+
+
 class BaseModel(flaskDb.Model):
 
+    @classmethod
+    def select(cls, *selection):
+        query = super(BaseModel, cls).select(*selection)
+        if read_replicas and getattr(db_routing, 'replica', False):
+            query.database = read_replicas[next(read_replica_turn) % len(read_replicas)]
+        return query
+
     @classmethod
     def get_all(cls):
         results = [m for m in cls.select().dicts()]
@@ -75,80 +257,110 @@ class BaseModel(flaskDb.Model):
 
 
 class Pokemon(BaseModel):
-    # We are base64 encoding the ids delivered by the api
-    # because they are too big for sqlite to handle
-    encounter_id = CharField(primary_key=True, max_length=50)
-    spawnpoint_id = CharField(index=True)
-    pokemon_id = IntegerField(index=True)
+    # The unsigned 64 bit ids from the api, stored signed (see
+    # encounter_id_to_db) because that is what SQLite can hold.
+    encounter_id = BigIntegerField(primary_key=True)
+    spawnpoint_id = CharField()
+    pokemon_id = IntegerField()
     latitude = DoubleField()
     longitude = DoubleField()
-    disappear_time = DateTimeField(index=True)
+    disappear_time = DateTimeField()
 
     class Meta:
-        indexes = ((('latitude', 'longitude'), False),)
+        # One per hot read: active Pokemon in a box, a species' sightings
+        # (covering get_appearances) and a spawnpoint's times for a species.
+        indexes = pokemon_indexes
 
     @staticmethod
-    def get_active(swLat, swLng, neLat, neLng):
-        if swLat is None or swLng is None or neLat is None or neLng is None:
-            query = (Pokemon
-                     .select()
-                     .where(Pokemon.disappear_time > datetime.utcnow())
-                     .dicts())
-        else:
-            query = (Pokemon
-                     .select()
-                     .where((Pokemon.disappear_time > datetime.utcnow()) &
-                            (((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))))
-                     .dicts())
+    def partitions(start=None, end=None):
+        # The tables holding the Pokemon that disappear between start and
+        # end, either of which may be left open.
+        if not args.db_daily_pokemon:
+            return [Pokemon]
+        days = get_partition_days()
+        # Rows stored before the daily tables may be from any day.
+        legacy = [Pokemon] if partition_days[2] else []
+        return legacy + [get_partition_model(day) for day in sorted(days)
+                         if (not start or day >= start.date()) and (not end or day <= end.date())]
 
-        # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append()
-        gc.disable()
+    @staticmethod
+    def get_active(swLat, swLng, neLat, neLng, encounter_ids=None):
+        return Pokemon._get_active(None, swLat, swLng, neLat, neLng, encounter_ids)
 
-        pokemons = []
+    @staticmethod
+    def get_active_by_id(ids, swLat, swLng, neLat, neLng, encounter_ids=None):
+        return Pokemon._get_active(ids, swLat, swLng, neLat, neLng, encounter_ids)
+
+    @staticmethod
+    def iter_active(swLat, swLng, neLat, neLng, ids=None, encounter_ids=None):
+        # Like get_active, but yields the rows as they are read.
+        if encounter_ids is not None and not encounter_ids:
+            return
+
+        if live_pokemon.enabled:
+            query = live_pokemon.get_active(swLat, swLng, neLat, neLng, ids)
+            if encounter_ids is not None:
+                query = (p for p in query if p['encounter_id'] in encounter_ids)
+        else:
+            query = itertools.chain.from_iterable(
+                q.iterator() for q in Pokemon._active_queries(ids, swLat, swLng, neLat, neLng, encounter_ids))
+
+        species = get_pokemon_species()
         for p in query:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
+            meta = species[p['pokemon_id']]
+            p['encounter_id'] = encounter_id_to_api(p['encounter_id'])
+            p['pokemon_name'] = meta['name']
+            p['pokemon_rarity'] = meta['rarity']
+            p['pokemon_types'] = meta['types']
             if args.china:
                 p['latitude'], p['longitude'] = \
                     transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokemons.append(p)
-
-        # Re-enable the GC.
-        gc.enable()
-
-        return pokemons
+            yield p
 
     @staticmethod
-    def get_active_by_id(ids, swLat, swLng, neLat, neLng):
-        if swLat is None or swLng is None or neLat is None or neLng is None:
-            query = (Pokemon
+    def _active_queries(ids, swLat, swLng, neLat, neLng, encounter_ids):
+        now = datetime.utcnow()
+        queries = []
+        for model in Pokemon.partitions(now):
+            query = (model
                      .select()
-                     .where((Pokemon.pokemon_id << ids) &
-                            (Pokemon.disappear_time > datetime.utcnow()))
-                     .dicts())
+                     .where(model.disappear_time > now))
+            if ids is not None:
+                query = query.where(model.pokemon_id << ids)
+            if not (swLat is None or swLng is None or neLat is None or neLng is None):
+                query = query.where((model.latitude >= swLat) &
+                                    (model.longitude >= swLng) &
+                                    (model.latitude <= neLat) &
+                                    (model.longitude <= neLng))
+            if encounter_ids is not None:
+                query = query.where(model.encounter_id << list(encounter_ids))
+            queries.append(query.dicts())
+        return queries
+
+    @staticmethod
+    def _get_active(ids, swLat, swLng, neLat, neLng, encounter_ids):
+        # encounter_ids limits the result to those rows, for delta updates.
+        if encounter_ids is not None and not encounter_ids:
+            return []
+
+        if live_pokemon.enabled:
+            query = live_pokemon.get_active(swLat, swLng, neLat, neLng, ids)
+            if encounter_ids is not None:
+                query = [p for p in query if p['encounter_id'] in encounter_ids]
         else:
-            query = (Pokemon
-                     .select()
-                     .where((Pokemon.pokemon_id << ids) &
-                            (Pokemon.disappear_time > datetime.utcnow()) &
-                            (Pokemon.latitude >= swLat) &
-                            (Pokemon.longitude >= swLng) &
-                            (Pokemon.latitude <= neLat) &
-                            (Pokemon.longitude <= neLng))
-                     .dicts())
+            query = itertools.chain(*Pokemon._active_queries(ids, swLat, swLng, neLat, neLng, encounter_ids))
 
         # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append()
         gc.disable()
 
+        species = get_pokemon_species()
         pokemons = []
         for p in query:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
+            meta = species[p['pokemon_id']]
+            p['encounter_id'] = encounter_id_to_api(p['encounter_id'])
+            p['pokemon_name'] = meta['name']
+            p['pokemon_rarity'] = meta['rarity']
+            p['pokemon_types'] = meta['types']
             if args.china:
                 p['latitude'], p['longitude'] = \
                     transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
@@ -159,39 +371,81 @@ class Pokemon(BaseModel):
 
         return pokemons
 
+    @staticmethod
+    def get_expired(since, swLat, swLng, neLat, neLng):
+        # Encounter ids of the Pokemon that disappeared after `since`.
+        now = datetime.utcnow()
+        expired = []
+        for model in Pokemon.partitions(since, now):
+            query = (model
+                     .select(model.encounter_id)
+                     .where((model.disappear_time > since) &
+                            (model.disappear_time <= now)))
+            if not (swLat is None or swLng is None or neLat is None or neLng is None):
+                query = query.where((model.latitude >= swLat) &
+                                    (model.longitude >= swLng) &
+                                    (model.latitude <= neLat) &
+                                    (model.longitude <= neLng))
+            expired.extend(encounter_id_to_api(e) for e in itertools.chain(*query.tuples()))
+
+        return expired
+
     @classmethod
     @cached(cache)
     def get_seen(cls, timediff):
+        # Whole hours are answered from the hourly rollups; the part of the
+        # window before the first of them is counted from the sightings.
+        start = hours_start = None
         if timediff:
-            timediff = datetime.utcnow() - timediff
-        pokemon_count_query = (Pokemon
-                               .select(Pokemon.pokemon_id,
-                                       fn.COUNT(Pokemon.pokemon_id).alias('count'),
-                                       fn.MAX(Pokemon.disappear_time).alias('lastappeared')
-                                       )
-                               .where(Pokemon.disappear_time > timediff)
-                               .group_by(Pokemon.pokemon_id)
+            start = datetime.utcnow() - timediff
+            hours_start = start.replace(minute=0, second=0, microsecond=0)
+            if hours_start < start:
+                hours_start += timedelta(hours=1)
+        pokemon_count_query = (PokemonRollup
+                               .select(PokemonRollup.pokemon_id,
+                                       fn.SUM(PokemonRollup.count).alias('count'),
+                                       fn.MAX(PokemonRollup.last_seen).alias('lastappeared')
+                                       ))
+        if hours_start:
+            pokemon_count_query = pokemon_count_query.where(PokemonRollup.hour >= hours_start)
+        pokemon_count_query = (pokemon_count_query
+                               .group_by(PokemonRollup.pokemon_id)
                                .alias('counttable')
                                )
-        query = (Pokemon
-                 .select(Pokemon.pokemon_id,
-                         Pokemon.disappear_time,
-                         Pokemon.latitude,
-                         Pokemon.longitude,
+        query = (PokemonRollup
+                 .select(PokemonRollup.pokemon_id,
+                         PokemonRollup.last_seen.alias('disappear_time'),
+                         PokemonRollup.latitude,
+                         PokemonRollup.longitude,
                          pokemon_count_query.c.count)
-                 .join(pokemon_count_query, on=(Pokemon.pokemon_id == pokemon_count_query.c.pokemon_id))
+                 .join(pokemon_count_query, on=(PokemonRollup.pokemon_id == pokemon_count_query.c.pokemon_id))
                  .distinct()
-                 .where(Pokemon.disappear_time == pokemon_count_query.c.lastappeared)
+                 .where(PokemonRollup.last_seen == pokemon_count_query.c.lastappeared)
                  .dicts()
                  )
 
         # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append()
         gc.disable()
 
+        seen = {}
+        for p in query:
+            # SUM() comes back as a Decimal on MySQL.
+            p['count'] = int(p['count'])
+            seen[p['pokemon_id']] = p
+
+        if start and start < hours_start:
+            for p in Pokemon.get_seen_between(start, hours_start):
+                if p['pokemon_id'] in seen:
+                    # The rollups have the later sighting.
+                    seen[p['pokemon_id']]['count'] += p['count']
+                else:
+                    seen[p['pokemon_id']] = p
+
+        species = get_pokemon_species()
         pokemons = []
         total = 0
-        for p in query:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+        for p in seen.values():
+            p['pokemon_name'] = species[p['pokemon_id']]['name']
             pokemons.append(p)
             total += p['count']
 
@@ -200,6 +454,72 @@ class Pokemon(BaseModel):
 
         return {'pokemon': pokemons, 'total': total}
 
+    @classmethod
+    def get_seen_between(cls, start, end):
+        # Sightings per species that disappeared after start and before end,
+        # with the last of them, as get_seen returns them. Only meant for
+        # short windows, the disappear_time index narrows them down.
+        seen = {}
+        for model in Pokemon.partitions(start, end):
+            window = (model.disappear_time > start) & (model.disappear_time < end)
+            counts = (model
+                      .select(model.pokemon_id,
+                              fn.Count(model.encounter_id).alias('count'),
+                              fn.MAX(model.disappear_time).alias('lastappeared'))
+                      .where(window)
+                      .group_by(model.pokemon_id)
+                      .alias('counttable'))
+            query = (model
+                     .select(model.pokemon_id,
+                             model.disappear_time,
+                             model.latitude,
+                             model.longitude,
+                             counts.c.count)
+                     .join(counts, on=(model.pokemon_id == counts.c.pokemon_id))
+                     .where(window & (model.disappear_time == counts.c.lastappeared))
+                     .dicts())
+            # Sightings tied for the last one each come with the count.
+            last_seen = {}
+            for p in query:
+                p['count'] = int(p['count'])
+                last_seen.setdefault(p['pokemon_id'], p)
+
+            # A species can also be in the pokemon table from before the
+            # daily tables as well as in a daily one.
+            for pokemon_id, p in last_seen.items():
+                last = seen.get(pokemon_id)
+                if last is None:
+                    seen[pokemon_id] = p
+                elif p['disappear_time'] > last['disappear_time']:
+                    p['count'] += last['count']
+                    seen[pokemon_id] = p
+                else:
+                    last['count'] += p['count']
+        return seen.values()
+
+    @classmethod
+    def get_stored(cls, rows):
+        # {encounter_id: model of the table holding it} for the rows whose
+        # encounters are in the database already. With daily tables, a
+        # corrected disappear_time can move a sighting to the next or
+        # previous day, so the days around the rows are looked at too.
+        rows = list(rows)
+        if not rows:
+            return {}
+        models = Pokemon.partitions(min(p['disappear_time'] for p in rows) - timedelta(days=1),
+                                    max(p['disappear_time'] for p in rows) + timedelta(days=1))
+        stored = {}
+        for model in models:
+            for i in range(0, len(rows), 500):
+                query = (model
+                         .select(model.encounter_id)
+                         .where(model.encounter_id << [p['encounter_id'] for p in rows[i:i + 500]])
+                         .tuples())
+                for encounter_id in itertools.chain(*query):
+                    stored[encounter_id] = model
+
+        return stored
+
     @classmethod
     def get_appearances(cls, pokemon_id, timediff):
         '''
@@ -209,16 +529,26 @@ class Pokemon(BaseModel):
         '''
         if timediff:
             timediff = datetime.utcnow() - timediff
-        query = (Pokemon
-                 .select(Pokemon.latitude, Pokemon.longitude, Pokemon.pokemon_id, fn.Count(Pokemon.spawnpoint_id).alias('count'), Pokemon.spawnpoint_id)
-                 .where((Pokemon.pokemon_id == pokemon_id) &
-                        (Pokemon.disappear_time > timediff)
-                        )
-                 .group_by(Pokemon.latitude, Pokemon.longitude, Pokemon.pokemon_id, Pokemon.spawnpoint_id)
-                 .dicts()
-                 )
+        appearances = {}
+        for model in Pokemon.partitions(timediff):
+            query = (model
+                     .select(model.latitude, model.longitude, model.pokemon_id, fn.Count(model.spawnpoint_id).alias('count'), model.spawnpoint_id)
+                     .where((model.pokemon_id == pokemon_id) &
+                            (model.disappear_time > timediff)
+                            )
+                     .group_by(model.latitude, model.longitude, model.pokemon_id, model.spawnpoint_id)
+                     .dicts()
+                     )
+            # The same spawn can show up in several days.
+            for a in query:
+                key = (a['latitude'], a['longitude'], a['spawnpoint_id'])
+                if key in appearances:
+                    appearances[key]['count'] += int(a['count'])
+                else:
+                    a['count'] = int(a['count'])
+                    appearances[key] = a
 
-        return list(query)
+        return appearances.values()
 
     @classmethod
     def get_appearances_times_by_spawnpoint(cls, pokemon_id, spawnpoint_id, timediff):
@@ -230,17 +560,21 @@ class Pokemon(BaseModel):
         '''
         if timediff:
             timediff = datetime.utcnow() - timediff
-        query = (Pokemon
-                 .select(Pokemon.disappear_time)
-                 .where((Pokemon.pokemon_id == pokemon_id) &
-                        (Pokemon.spawnpoint_id == spawnpoint_id) &
-                        (Pokemon.disappear_time > timediff)
-                        )
-                 .order_by(Pokemon.disappear_time.asc())
-                 .tuples()
-                 )
-
-        return list(itertools.chain(*query))
+        times = []
+        # Partitions come in day order, so the times stay sorted.
+        for model in Pokemon.partitions(timediff):
+            query = (model
+                     .select(model.disappear_time)
+                     .where((model.pokemon_id == pokemon_id) &
+                            (model.spawnpoint_id == spawnpoint_id) &
+                            (model.disappear_time > timediff)
+                            )
+                     .order_by(model.disappear_time.asc())
+                     .tuples()
+                     )
+            times.extend(itertools.chain(*query))
+
+        return times
 
     @classmethod
     def get_spawn_time(cls, disappear_time):
@@ -248,39 +582,30 @@ class Pokemon(BaseModel):
 
     @classmethod
     def get_spawnpoints(cls, southBoundary, westBoundary, northBoundary, eastBoundary):
-        query = Pokemon.select(Pokemon.latitude, Pokemon.longitude, Pokemon.spawnpoint_id, ((Pokemon.disappear_time.minute * 60) + Pokemon.disappear_time.second).alias('time'), fn.Count(Pokemon.spawnpoint_id).alias('count'))
+        return list(cls.iter_spawnpoints(southBoundary, westBoundary, northBoundary, eastBoundary))
+
+    @classmethod
+    def iter_spawnpoints(cls, southBoundary, westBoundary, northBoundary, eastBoundary):
+        # Like get_spawnpoints, but yields the rows as they are read.
+        query = Spawnpoint.select(Spawnpoint.latitude,
+                                  Spawnpoint.longitude,
+                                  Spawnpoint.spawnpoint_id,
+                                  Spawnpoint.despawn_sec,
+                                  Spawnpoint.special)
 
         if None not in (northBoundary, southBoundary, westBoundary, eastBoundary):
             query = (query
-                     .where((Pokemon.latitude <= northBoundary) &
-                            (Pokemon.latitude >= southBoundary) &
-                            (Pokemon.longitude >= westBoundary) &
-                            (Pokemon.longitude <= eastBoundary)
+                     .where((Spawnpoint.latitude <= northBoundary) &
+                            (Spawnpoint.latitude >= southBoundary) &
+                            (Spawnpoint.longitude >= westBoundary) &
+                            (Spawnpoint.longitude <= eastBoundary)
                             ))
 
-        query = query.group_by(Pokemon.latitude, Pokemon.longitude, Pokemon.spawnpoint_id, SQL('time'))
-
-        queryDict = query.dicts()
-        spawnpoints = {}
-
-        for sp in queryDict:
-            key = sp['spawnpoint_id']
-            disappear_time = cls.get_spawn_time(sp.pop('time'))
-            count = int(sp['count'])
-
-            if key not in spawnpoints:
-                spawnpoints[key] = sp
-            else:
-                spawnpoints[key]['special'] = True
-
-            if 'time' not in spawnpoints[key] or count >= spawnpoints[key]['count']:
-                spawnpoints[key]['time'] = disappear_time
-                spawnpoints[key]['count'] = count
-
-        for sp in spawnpoints.values():
-            del sp['count']
-
-        return list(spawnpoints.values())
+        for sp in query.dicts().iterator():
+            sp['time'] = cls.get_spawn_time(sp.pop('despawn_sec'))
+            if sp.pop('special'):
+                sp['special'] = True
+            yield sp
 
     @classmethod
     def get_spawnpoints_in_hex(cls, center, steps):
@@ -288,22 +613,17 @@ class Pokemon(BaseModel):
 
         n, e, s, w = hex_bounds(center, steps)
 
-        query = (Pokemon
-                 .select(Pokemon.latitude.alias('lat'),
-                         Pokemon.longitude.alias('lng'),
-                         ((Pokemon.disappear_time.minute * 60) + Pokemon.disappear_time.second).alias('time'),
-                         Pokemon.spawnpoint_id
+        query = (Spawnpoint
+                 .select(Spawnpoint.latitude.alias('lat'),
+                         Spawnpoint.longitude.alias('lng'),
+                         Spawnpoint.despawn_sec.alias('time'),
+                         Spawnpoint.spawnpoint_id
                          ))
-        query = (query.where((Pokemon.latitude <= n) &
-                             (Pokemon.latitude >= s) &
-                             (Pokemon.longitude >= w) &
-                             (Pokemon.longitude <= e)
+        query = (query.where((Spawnpoint.latitude <= n) &
+                             (Spawnpoint.latitude >= s) &
+                             (Spawnpoint.longitude >= w) &
+                             (Spawnpoint.longitude <= e)
                              ))
-        # Sqlite doesn't support distinct on columns
-        if args.db_type == 'mysql':
-            query = query.distinct(Pokemon.spawnpoint_id)
-        else:
-            query = query.group_by(Pokemon.spawnpoint_id)
 
         s = list(query.dicts())
 
@@ -311,12 +631,7 @@ class Pokemon(BaseModel):
         # steps - 1 to account for the center circle then add 70 for the edge
         step_distance = ((steps - 1) * 121.2436) + 70
         # Compare spawnpoint list to a circle with radius steps * 120
-        # Uses the direct geopy distance between the center and the spawnpoint.
-        filtered = []
-
-        for idx, sp in enumerate(s):
-            if geopy.distance.distance(center, (sp['lat'], sp['lng'])).meters <= step_distance:
-                filtered.append(s[idx])
+        filtered = filter_within(center, s, step_distance)
 
         # at this point, 'time' is DISAPPEARANCE time, we're going to morph it to APPEARANCE time
         for location in filtered:
@@ -329,6 +644,224 @@ class Pokemon(BaseModel):
         return filtered
 
 
+# Per-species, per-hour sighting counts with the last sighting of each hour,
+# kept up to date as new encounters are written. Pokemon.get_seen sums these
+# instead of grouping the whole Pokemon table.
+class PokemonRollup(BaseModel):
+    pokemon_id = IntegerField()
+    hour = DateTimeField(index=True)
+    count = IntegerField()
+    last_seen = DateTimeField()
+    latitude = DoubleField()
+    longitude = DoubleField()
+
+    class Meta:
+        primary_key = CompositeKey('pokemon_id', 'hour')
+
+    @staticmethod
+    def group(rows):
+        rollups = {}
+        for p in rows:
+            key = (p['pokemon_id'], p['disappear_time'].replace(minute=0, second=0, microsecond=0))
+            if key not in rollups:
+                rollups[key] = {
+                    'pokemon_id': key[0],
+                    'hour': key[1],
+                    'count': 0,
+                    'last_seen': p['disappear_time'],
+                    'latitude': p['latitude'],
+                    'longitude': p['longitude']
+                }
+            r = rollups[key]
+            r['count'] += 1
+            if p['disappear_time'] > r['last_seen']:
+                r['last_seen'] = p['disappear_time']
+                r['latitude'] = p['latitude']
+                r['longitude'] = p['longitude']
+        return rollups
+
+    @staticmethod
+    def add(rows):
+        # Only ever given encounters the caller just inserted, so each is
+        # counted once. The increments are single UPDATE statements, so
+        # concurrent writers add to rather than overwrite each other's counts.
+        for key, r in PokemonRollup.group(rows).items():
+            rollup = ((PokemonRollup.pokemon_id == key[0]) &
+                      (PokemonRollup.hour == key[1]))
+            updated = (PokemonRollup
+                       .update(count=PokemonRollup.count + r['count'])
+                       .where(rollup)
+                       .execute())
+            if not updated:
+                try:
+                    InsertQuery(PokemonRollup, r).execute()
+                    continue
+                except IntegrityError:
+                    # Someone else created it first.
+                    (PokemonRollup
+                     .update(count=PokemonRollup.count + r['count'])
+                     .where(rollup)
+                     .execute())
+            (PokemonRollup
+             .update(last_seen=r['last_seen'],
+                     latitude=r['latitude'],
+                     longitude=r['longitude'])
+             .where(rollup & (PokemonRollup.last_seen < r['last_seen']))
+             .execute())
+
+    @staticmethod
+    def backfill():
+        log.info('Building hourly Pokemon rollups from existing sightings, this can take a while')
+        query = itertools.chain.from_iterable(
+            model.select(model.pokemon_id,
+                         model.disappear_time,
+                         model.latitude,
+                         model.longitude)
+            .dicts()
+            .iterator()
+            for model in Pokemon.partitions())
+        rollups = PokemonRollup.group(query)
+        run_with_retries(bulk_upsert, PokemonRollup, rollups)
+        log.info('Built %d hourly Pokemon rollups', len(rollups))
+
+
+# Every spawnpoint seen so far, kept up to date as new encounters are written
+# so the spawnpoint schedulers don't have to group the Pokemon history.
+class Spawnpoint(BaseModel):
+    spawnpoint_id = CharField(primary_key=True, max_length=50)
+    latitude = DoubleField()
+    longitude = DoubleField()
+    # Second of the hour the spawn disappears at. Sightings vote for their
+    # own second (Boyer-Moore majority vote), so occasional bad timers don't
+    # displace the real one. despawn_votes is how far it leads, and may be
+    # 0, in which case the next other second takes over.
+    despawn_sec = IntegerField()
+    despawn_votes = IntegerField()
+    count = IntegerField()
+    # Seen disappearing at more than one second of the hour.
+    special = BooleanField()
+
+    class Meta:
+        indexes = ((('latitude', 'longitude'), False),)
+
+    @staticmethod
+    def add(rows):
+        # Only ever given encounters the caller just inserted. Like the
+        # rollups, the votes are cast with single UPDATE statements, each
+        # only matching the state it was worked out for, so concurrent
+        # writers can't overwrite each other's votes.
+        votes = {}
+        for p in rows:
+            despawn_sec = p['disappear_time'].minute * 60 + p['disappear_time'].second
+            key = (p['spawnpoint_id'], despawn_sec)
+            if key not in votes:
+                votes[key] = {
+                    'spawnpoint_id': p['spawnpoint_id'],
+                    'latitude': p['latitude'],
+                    'longitude': p['longitude'],
+                    'despawn_sec': despawn_sec,
+                    'despawn_votes': 0,
+                    'count': 0,
+                    'special': False
+                }
+            votes[key]['despawn_votes'] += 1
+            votes[key]['count'] += 1
+
+        for (spawnpoint_id, despawn_sec), sp in votes.items():
+            n = sp['count']
+            spawnpoint = Spawnpoint.spawnpoint_id == spawnpoint_id
+            while True:
+                # The same second: n more votes for it.
+                if (Spawnpoint
+                        .update(count=Spawnpoint.count + n,
+                                despawn_votes=Spawnpoint.despawn_votes + n)
+                        .where(spawnpoint & (Spawnpoint.despawn_sec == despawn_sec))
+                        .execute()):
+                    break
+                # Another second, with at least as many votes: each of the
+                # n takes one of them. On a tie it keeps its second with no
+                # votes left.
+                if (Spawnpoint
+                        .update(count=Spawnpoint.count + n,
+                                special=True,
+                                despawn_votes=Spawnpoint.despawn_votes - n)
+                        .where(spawnpoint &
+                               (Spawnpoint.despawn_sec != despawn_sec) &
+                               (Spawnpoint.despawn_votes >= n))
+                        .execute()):
+                    break
+                # Another second, with fewer votes: those are used up by as
+                # many of the n, and this second leads by the rest.
+                if (Spawnpoint
+                        .update(count=Spawnpoint.count + n,
+                                special=True,
+                                despawn_sec=despawn_sec,
+                                despawn_votes=n - Spawnpoint.despawn_votes)
+                        .where(spawnpoint &
+                               (Spawnpoint.despawn_sec != despawn_sec) &
+                               (Spawnpoint.despawn_votes < n))
+                        .execute()):
+                    break
+                try:
+                    InsertQuery(Spawnpoint, sp).execute()
+                    break
+                except IntegrityError:
+                    # Someone else created it first; vote again.
+                    pass
+
+    @staticmethod
+    def backfill():
+        log.info('Building spawnpoint list from existing sightings, this can take a while')
+        # Sightings per spawnpoint and second, summed over the partitions.
+        seconds = {}
+        for model in Pokemon.partitions():
+            query = (model
+                     .select(model.latitude,
+                             model.longitude,
+                             model.spawnpoint_id,
+                             ((model.disappear_time.minute * 60) + model.disappear_time.second).alias('despawn_sec'),
+                             fn.Count(model.spawnpoint_id).alias('sightings'))
+                     .group_by(model.latitude, model.longitude, model.spawnpoint_id, SQL('despawn_sec'))
+                     .dicts())
+            for sp in query:
+                key = (sp['spawnpoint_id'], sp['despawn_sec'])
+                if key in seconds:
+                    seconds[key]['sightings'] += int(sp['sightings'])
+                else:
+                    sp['sightings'] = int(sp['sightings'])
+                    seconds[key] = sp
+
+        # Take the most seen second of each spawnpoint. That is also where
+        # add()'s vote ends up whenever a second has most of the sightings,
+        # whatever order they came in; otherwise the vote depends on the
+        # order and neither second is reliable (the spawnpoint is special
+        # either way). The votes are set to the least add() could have
+        # left, the lead over all other seconds together, so a bad
+        # backfill is voted out as easily as one from add().
+        spawnpoints = {}
+        for sp in seconds.values():
+            count = sp.pop('sightings')
+            key = sp['spawnpoint_id']
+            if key not in spawnpoints:
+                sp['count'] = count
+                sp['despawn_votes'] = count
+                sp['special'] = False
+                spawnpoints[key] = sp
+                continue
+
+            spawnpoints[key]['special'] = True
+            spawnpoints[key]['count'] += count
+            if count > spawnpoints[key]['despawn_votes']:
+                spawnpoints[key]['despawn_sec'] = sp['despawn_sec']
+                spawnpoints[key]['despawn_votes'] = count
+
+        for sp in spawnpoints.values():
+            sp['despawn_votes'] = max(0, 2 * sp['despawn_votes'] - sp['count'])
+
+        run_with_retries(bulk_upsert, Spawnpoint, spawnpoints)
+        log.info('Found %d spawnpoints', len(spawnpoints))
+
+
 class Pokestop(BaseModel):
     pokestop_id = CharField(primary_key=True, max_length=50)
     enabled = BooleanField()
@@ -342,35 +875,38 @@ class Pokestop(BaseModel):
         indexes = ((('latitude', 'longitude'), False),)
 
     @staticmethod
-    def get_stops(swLat, swLng, neLat, neLng):
-        if swLat is None or swLng is None or neLat is None or neLng is None:
-            query = (Pokestop
-                     .select()
-                     .dicts())
-        else:
-            query = (Pokestop
-                     .select()
-                     .where((Pokestop.latitude >= swLat) &
-                            (Pokestop.longitude >= swLng) &
-                            (Pokestop.latitude <= neLat) &
-                            (Pokestop.longitude <= neLng))
-                     .dicts())
-
+    def get_stops(swLat, swLng, neLat, neLng, pokestop_ids=None):
         # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append()
         gc.disable()
 
-        pokestops = []
-        for p in query:
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
-            pokestops.append(p)
+        pokestops = list(Pokestop.iter_stops(swLat, swLng, neLat, neLng, pokestop_ids))
 
         # Re-enable the GC.
         gc.enable()
 
         return pokestops
 
+    @staticmethod
+    def iter_stops(swLat, swLng, neLat, neLng, pokestop_ids=None):
+        # Like get_stops, but yields the rows as they are read.
+        if pokestop_ids is not None and not pokestop_ids:
+            return
+
+        query = Pokestop.select()
+        if not (swLat is None or swLng is None or neLat is None or neLng is None):
+            query = query.where((Pokestop.latitude >= swLat) &
+                                (Pokestop.longitude >= swLng) &
+                                (Pokestop.latitude <= neLat) &
+                                (Pokestop.longitude <= neLng))
+        if pokestop_ids is not None:
+            query = query.where(Pokestop.pokestop_id << list(pokestop_ids))
+
+        for p in query.dicts().iterator():
+            if args.china:
+                p['latitude'], p['longitude'] = \
+                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
+            yield p
+
 
 class Gym(BaseModel):
     UNCONTESTED = 0
@@ -392,66 +928,98 @@ class Gym(BaseModel):
         indexes = ((('latitude', 'longitude'), False),)
 
     @staticmethod
-    def get_gyms(swLat, swLng, neLat, neLng):
-        if swLat is None or swLng is None or neLat is None or neLng is None:
-            results = (Gym
-                       .select()
-                       .dicts())
-        else:
-            results = (Gym
-                       .select()
-                       .where((Gym.latitude >= swLat) &
-                              (Gym.longitude >= swLng) &
-                              (Gym.latitude <= neLat) &
-                              (Gym.longitude <= neLng))
-                       .dicts())
-
+    def get_gyms(swLat, swLng, neLat, neLng, gym_ids=None):
         # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append()
         gc.disable()
 
-        gyms = {}
-        gym_ids = []
-        for g in results:
-            g['name'] = None
-            g['pokemon'] = []
-            gyms[g['gym_id']] = g
-            gym_ids.append(g['gym_id'])
-
-        if len(gym_ids) > 0:
-            pokemon = (GymMember
-                       .select(
-                           GymMember.gym_id,
-                           GymPokemon.cp.alias('pokemon_cp'),
-                           GymPokemon.pokemon_id,
-                           Trainer.name.alias('trainer_name'),
-                           Trainer.level.alias('trainer_level'))
-                       .join(Gym, on=(GymMember.gym_id == Gym.gym_id))
-                       .join(GymPokemon, on=(GymMember.pokemon_uid == GymPokemon.pokemon_uid))
-                       .join(Trainer, on=(GymPokemon.trainer_name == Trainer.name))
-                       .where(GymMember.gym_id << gym_ids)
-                       .where(GymMember.last_scanned > Gym.last_modified)
-                       .order_by(GymMember.gym_id, GymPokemon.cp)
-                       .dicts())
-
-            for p in pokemon:
-                p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-                gyms[p['gym_id']]['pokemon'].append(p)
-
-            details = (GymDetails
-                       .select(
-                           GymDetails.gym_id,
-                           GymDetails.name)
-                       .where(GymDetails.gym_id << gym_ids)
-                       .dicts())
-
-            for d in details:
-                gyms[d['gym_id']]['name'] = d['name']
+        gyms = dict((g['gym_id'], g) for g in Gym.iter_gyms(swLat, swLng, neLat, neLng, gym_ids))
 
         # Re-enable the GC.
         gc.enable()
 
         return gyms
 
+    @staticmethod
+    def iter_gyms(swLat, swLng, neLat, neLng, gym_ids=None):
+        # Like get_gyms, but yields the gyms as they are read, their rosters
+        # looked up a batch at a time.
+        if gym_ids is not None and not gym_ids:
+            return
+
+        results = Gym.select()
+        if not (swLat is None or swLng is None or neLat is None or neLng is None):
+            results = results.where((Gym.latitude >= swLat) &
+                                    (Gym.longitude >= swLng) &
+                                    (Gym.latitude <= neLat) &
+                                    (Gym.longitude <= neLng))
+        if gym_ids is not None:
+            results = results.where(Gym.gym_id << list(gym_ids))
+        results = results.dicts().iterator()
+
+        while True:
+            # Stay well inside SQLite's limit on query parameters.
+            gyms = list(itertools.islice(results, 500))
+            if not gyms:
+                return
+
+            # Rosters only change when parse_gyms runs, which invalidates
+            # them, so only the gyms we haven't seen since need the join.
+            rosters, generations = gym_rosters.get(g['gym_id'] for g in gyms)
+            missing = [g['gym_id'] for g in gyms if g['gym_id'] not in rosters]
+            if missing:
+                # Cached for everyone, so not from a lagging replica.
+                with read_from_primary():
+                    loaded = Gym.get_rosters(missing)
+                gym_rosters.update(loaded, generations)
+                rosters.update(loaded)
+
+            for g in gyms:
+                g['name'] = None
+                g['pokemon'] = []
+                if g['gym_id'] in rosters:
+                    g['name'] = rosters[g['gym_id']]['name']
+                    # Members scanned before the gym last changed are outdated.
+                    g['pokemon'] = [dict(p) for last_scanned, p in rosters[g['gym_id']]['pokemon']
+                                    if last_scanned > g['last_modified']]
+                yield g
+
+    @staticmethod
+    def get_rosters(gym_ids):
+        rosters = {}
+        for gym_id in gym_ids:
+            rosters[gym_id] = {'name': None, 'pokemon': []}
+
+        pokemon = (GymMember
+                   .select(
+                       GymMember.gym_id,
+                       GymMember.last_scanned,
+                       GymPokemon.cp.alias('pokemon_cp'),
+                       GymPokemon.pokemon_id,
+                       Trainer.name.alias('trainer_name'),
+                       Trainer.level.alias('trainer_level'))
+                   .join(GymPokemon, on=(GymMember.pokemon_uid == GymPokemon.pokemon_uid))
+                   .join(Trainer, on=(GymPokemon.trainer_name == Trainer.name))
+                   .where(GymMember.gym_id << gym_ids)
+                   .order_by(GymMember.gym_id, GymPokemon.cp)
+                   .dicts())
+
+        species = get_pokemon_species()
+        for p in pokemon:
+            p['pokemon_name'] = species[p['pokemon_id']]['name']
+            rosters[p['gym_id']]['pokemon'].append((p.pop('last_scanned'), p))
+
+        details = (GymDetails
+                   .select(
+                       GymDetails.gym_id,
+                       GymDetails.name)
+                   .where(GymDetails.gym_id << gym_ids)
+                   .dicts())
+
+        for d in details:
+            rosters[d['gym_id']]['name'] = d['name']
+
+        return rosters
+
 
 class ScannedLocation(BaseModel):
     latitude = DoubleField()
@@ -462,19 +1030,30 @@ class ScannedLocation(BaseModel):
         primary_key = CompositeKey('latitude', 'longitude')
 
     @staticmethod
-    def get_recent(swLat, swLng, neLat, neLng):
+    def get_recent(swLat, swLng, neLat, neLng, locations=None):
+        # `locations` limits the result to those (latitude, longitude) keys,
+        # for delta updates.
+        return list(ScannedLocation.iter_recent(swLat, swLng, neLat, neLng, locations))
+
+    @staticmethod
+    def iter_recent(swLat, swLng, neLat, neLng, locations=None):
+        # Like get_recent, but yields the rows as they are read.
+        if locations is not None and not locations:
+            return
+
         query = (ScannedLocation
                  .select()
-                 .where((ScannedLocation.last_modified >=
-                        (datetime.utcnow() - timedelta(minutes=15))) &
-                        (ScannedLocation.latitude >= swLat) &
-                        (ScannedLocation.longitude >= swLng) &
-                        (ScannedLocation.latitude <= neLat) &
-                        (ScannedLocation.longitude <= neLng))
-                 .order_by(ScannedLocation.last_modified.asc())
-                 .dicts())
+                 .where(ScannedLocation.last_modified >=
+                        (datetime.utcnow() - timedelta(minutes=15))))
+        if not (swLat is None or swLng is None or neLat is None or neLng is None):
+            query = query.where((ScannedLocation.latitude >= swLat) &
+                                (ScannedLocation.longitude >= swLng) &
+                                (ScannedLocation.latitude <= neLat) &
+                                (ScannedLocation.longitude <= neLng))
 
-        return list(query)
+        for s in query.order_by(ScannedLocation.last_modified.asc()).dicts().iterator():
+            if locations is None or (s['latitude'], s['longitude']) in locations:
+                yield s
 
 
 class MainWorker(BaseModel):
@@ -561,6 +1140,28 @@ class GymDetails(BaseModel):
     url = CharField()
     last_scanned = DateTimeField(default=datetime.utcnow)
 
+    @staticmethod
+    def get_last_scanned(gym_ids):
+        # {gym_id: last_scanned} for the gyms that have details. All of them
+        # are loaded the first time; after that parse_gyms keeps the map
+        # current and only gyms it hasn't seen are looked up.
+        if not gym_freshness.warmed:
+            query = GymDetails.select(GymDetails.gym_id, GymDetails.last_scanned).tuples()
+            gym_freshness.update(query.iterator(), warmed=True)
+
+        last_scanned = gym_freshness.get(gym_ids)
+        missing = [gym_id for gym_id in gym_ids if gym_id not in last_scanned]
+        if missing:
+            query = (GymDetails
+                     .select(GymDetails.gym_id, GymDetails.last_scanned)
+                     .where(GymDetails.gym_id << missing)
+                     .tuples())
+            found = list(query)
+            gym_freshness.update(found)
+            last_scanned.update(found)
+
+        return last_scanned
+
 
 def hex_bounds(center, steps):
     # Make a box that is (70m * step_limit * 2) + 70m away from the center point
@@ -574,10 +1175,19 @@ def hex_bounds(center, steps):
 
 
 # todo: this probably shouldn't _really_ be in "models" anymore, but w/e
+# The fort fields that can change between scans. parse_map doesn't queue
+# forts whose values match what was last written.
+fort_fingerprint_fields = {
+    Pokestop: ('enabled', 'last_modified', 'lure_expiration', 'active_fort_modifier'),
+    Gym: ('enabled', 'last_modified', 'team_id', 'guard_pokemon_id', 'gym_points'),
+}
+
+
 def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue):
     pokemons = {}
     pokestops = {}
     gyms = {}
+    pokemons_found = 0
 
     cells = map_dict['responses']['GET_MAP_OBJECTS']['map_cells']
     for cell in cells:
@@ -593,10 +1203,17 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue):
                     # Set a value of 15 minutes because currently its unknown but larger than 15.
                     d_t = datetime.utcfromtimestamp((p['last_modified_timestamp_ms'] + 900000) / 1000.0)
 
+                # Another worker (or an earlier scan) already sent this one
+                # to the db and webhooks.
+                pokemons_found += 1
+                encounter_id = encounter_id_to_db(p['encounter_id'])
+                if not seen_encounters.add(encounter_id, d_t):
+                    continue
+
                 printPokemon(p['pokemon_data']['pokemon_id'], p['latitude'],
                              p['longitude'], d_t)
                 pokemons[p['encounter_id']] = {
-                    'encounter_id': b64encode(str(p['encounter_id'])),
+                    'encounter_id': encounter_id,
                     'spawnpoint_id': p['spawn_point_id'],
                     'pokemon_id': p['pokemon_data']['pokemon_id'],
                     'latitude': p['latitude'],
@@ -695,29 +1312,38 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue):
 
     if len(pokemons):
         db_update_queue.put((Pokemon, pokemons))
-    if len(pokestops):
-        db_update_queue.put((Pokestop, pokestops))
-    if len(gyms):
-        db_update_queue.put((Gym, gyms))
-
-    log.info('Parsing found %d pokemons, %d pokestops, and %d gyms',
+        if live_pokemon.enabled:
+            live_pokemon.add(pokemons.values())
+    # Overlapping scans see the same forts over and over; only write the
+    # ones that changed.
+    changed_pokestops = dict((k, p) for k, p in pokestops.items()
+                             if fort_fingerprints.changed(k, fort_fingerprint(Pokestop, p)))
+    changed_gyms = dict((k, g) for k, g in gyms.items()
+                        if fort_fingerprints.changed(k, fort_fingerprint(Gym, g)))
+    if len(changed_pokestops):
+        db_update_queue.put((Pokestop, changed_pokestops))
+    if len(changed_gyms):
+        db_update_queue.put((Gym, changed_gyms))
+
+    log.info('Parsing found %d pokemons (%d new), %d pokestops, and %d gyms',
+             pokemons_found,
              len(pokemons),
              len(pokestops),
              len(gyms))
 
-    db_update_queue.put((ScannedLocation, {0: {
+    scanned_locations.add((step_location[0], step_location[1]), {
         'latitude': step_location[0],
         'longitude': step_location[1],
         'last_modified': datetime.utcnow()
-    }}))
+    })
 
     return {
-        'count': len(pokemons) + len(pokestops) + len(gyms),
+        'count': pokemons_found + len(pokestops) + len(gyms),
         'gyms': gyms,
     }
 
 
-def parse_gyms(args, gym_responses, wh_update_queue):
+def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
     gym_details = {}
     gym_members = {}
     gym_pokemon = {}
@@ -812,6 +1438,41 @@ def parse_gyms(args, gym_responses, wh_update_queue):
     # We _could_ synchronously upsert GymDetails, then queue the other tables for
     # upsert, but that would put that Gym's overall information in a weird non-atomic state.
 
+    # The writes go to the db updater as one unit, so the worker can get
+    # back to scanning. Until they're done, the gyms count as pending, which
+    # the workers take as up to date.
+    def written(task):
+        pending_gym_details.discard(gym_details.keys())
+        if task.error is not None:
+            log.error('Failed to upsert details of %d gyms: %s', len(gym_details), task.error)
+            return
+
+        written_at = datetime.utcnow()
+        gym_freshness.update((gym_id, written_at) for gym_id in gym_details)
+        gym_rosters.invalidate(gym_details.keys())
+        if tile_cache.enabled:
+            tile_cache.invalidate('gym', [(g['gym_state']['fort_data']['latitude'],
+                                           g['gym_state']['fort_data']['longitude'])
+                                          for g in gym_responses.values()])
+
+        # Rosters and names are part of the gym as the map sees it.
+        if change_journal.enabled:
+            change_journal.record('gym', gym_details.keys())
+
+        log.info('Upserted %d gyms and %d gym members',
+                 len(gym_details),
+                 len(gym_members))
+
+    pending_gym_details.add(gym_details.keys())
+    db_update_queue.put((DbTask, DbTask(run_with_retries,
+                                        (write_gyms, gym_details, gym_pokemon, trainers, gym_members),
+                                        written)))
+
+
+def write_gyms(gym_details, gym_pokemon, trainers, gym_members):
+    # This needs to be completed in a transaction, because we don't wany any other thread or process
+    # to mess with the GymMembers for the gyms we're updating while we're updating the bridge table,
+    # nor see a gym's details without its members. Run it through run_with_retries.
     # upsert all the models
     if len(gym_details):
         bulk_upsert(GymDetails, gym_details)
@@ -820,23 +1481,33 @@ def parse_gyms(args, gym_responses, wh_update_queue):
     if len(trainers):
         bulk_upsert(Trainer, trainers)
 
-    # This needs to be completed in a transaction, because we don't wany any other thread or process
-    # to mess with the GymMembers for the gyms we're updating while we're updating the bridge table.
-    with flaskDb.database.transaction():
-        # get rid of all the gym members, we're going to insert new records
-        if len(gym_details):
-            DeleteQuery(GymMember).where(GymMember.gym_id << gym_details.keys()).execute()
+    # get rid of all the gym members, we're going to insert new records
+    if len(gym_details):
+        DeleteQuery(GymMember).where(GymMember.gym_id << gym_details.keys()).execute()
 
-        # insert new gym members
-        if len(gym_members):
-            bulk_upsert(GymMember, gym_members)
+    # insert new gym members
+    if len(gym_members):
+        bulk_upsert(GymMember, gym_members)
 
-    log.info('Upserted %d gyms and %d gym members',
-             len(gym_details),
-             len(gym_members))
+
+def write_pending(q, pending):
+    # Returns the (model, rows) written, for db_upserted once they're
+    # committed.
+    written = []
+    for model, rows in pending.items():
+        db_upsert(model, rows)
+        written.append((model, rows))
+        log.debug('Upserted to %s, %d records (upsert queue remaining: %d)',
+                  model.__name__,
+                  len(rows),
+                  q.qsize())
+    return written
 
 
 def db_updater(args, q):
+    # The only thread writing to the database in --db-sqlite-wal mode.
+    sqlite_writer.enabled = True
+
     # The forever loop
     while True:
         try:
@@ -851,92 +1522,547 @@ def db_updater(args, q):
             # Loop the queue
             while True:
                 model, data = q.get()
-                bulk_upsert(model, data)
-                q.task_done()
-                log.debug('Upserted to %s, %d records (upsert queue remaining: %d)',
-                          model.__name__,
-                          len(data),
-                          q.qsize())
+                flush_time = time.time() + db_flush_seconds
+                pending = {}
+                task = None
+                num_items = 1
+                num_rows = 0
+
+                try:
+                    # Take whatever else is queued until the batch is big or
+                    # old enough. Rows are keyed by primary key, so a row
+                    # queued again (e.g. the same spawn seen by two workers)
+                    # is written once, with the latest data.
+                    while True:
+                        if model is DbTask:
+                            # Runs once the rows queued before it are written.
+                            task = data
+                            break
+
+                        rows = pending.setdefault(model, {})
+                        num_rows -= len(rows)
+                        rows.update(zip(row_keys(model, data.values()), data.values()))
+                        num_rows += len(rows)
+
+                        timeout = flush_time - time.time()
+                        if num_rows >= db_flush_rows or timeout <= 0:
+                            break
+                        try:
+                            model, data = q.get(timeout=timeout)
+                            num_items += 1
+                        except Empty:
+                            break
+
+                    # With a single writer, one commit per batch.
+                    if args.db_sqlite_wal:
+                        batches = [pending]
+                    else:
+                        batches = [{m: r} for m, r in pending.items()]
+                    for batch in batches:
+                        try:
+                            written = run_with_retries(write_pending, q, batch)
+                        except Exception:
+                            # Already logged; go on with the other models.
+                            db_write_failed(batch)
+                            continue
+                        # Only now that other connections can read the rows.
+                        for model, rows in written:
+                            db_upserted(model, rows)
+                finally:
+                    # Even if the rows failed, so nothing waits on the task
+                    # (or the queue) forever.
+                    if task is not None:
+                        task.run()
+                    for i in range(num_items):
+                        q.task_done()
                 if q.qsize() > 50:
-                    log.warning("DB queue is > 50 (@%d); try increasing --db-threads", q.qsize())
+                    log.warning("DB queue is > 50 (@%d, %d puts blocked so far); try increasing --db-threads",
+                                q.qsize(), q.blocked_puts)
 
         except Exception as e:
             log.exception('Exception in db_updater: %s', e)
 
 
-def clean_db_loop(args):
+def init_live_pokemon():
+    # Seed the in-memory index with whatever is still visible, then let
+    # parse_map keep it current.
+    now = datetime.utcnow()
+    for model in Pokemon.partitions(now):
+        query = (model
+                 .select()
+                 .where(model.disappear_time > now)
+                 .dicts())
+        live_pokemon.add(query)
+    live_pokemon.enabled = True
+    log.info('Loaded %d active Pokemon into memory', len(live_pokemon))
+
+
+def clean_db_loop(args, db_updates_queue):
     while True:
         try:
-            # Clean out old scanned locations
-            query = (ScannedLocation
-                     .delete()
-                     .where((ScannedLocation.last_modified <
-                             (datetime.utcnow() - timedelta(minutes=30)))))
-            query.execute()
-
-            query = (MainWorker
-                     .delete()
-                     .where((ScannedLocation.last_modified <
-                             (datetime.utcnow() - timedelta(minutes=30)))))
-            query.execute()
-
-            query = (WorkerStatus
-                     .delete()
-                     .where((ScannedLocation.last_modified <
-                             (datetime.utcnow() - timedelta(minutes=30)))))
-            query.execute()
-
-            # Remove active modifier from expired lured pokestops
-            query = (Pokestop
-                     .update(lure_expiration=None)
-                     .where(Pokestop.lure_expiration < datetime.utcnow()))
-            query.execute()
-
-            # If desired, clear old pokemon spawns
-            if args.purge_data > 0:
-                query = (Pokemon
-                         .delete()
-                         .where((Pokemon.disappear_time <
-                                (datetime.utcnow() - timedelta(hours=args.purge_data)))))
-
+            clean_db(args, db_updates_queue)
             log.info('Regular database cleaning complete')
             time.sleep(60)
         except Exception as e:
             log.exception('Exception in clean_db_loop: %s', e)
 
 
-def bulk_upsert(cls, data):
-    num_rows = len(data.values())
-    i = 0
+def clean_db(args, db_updates_queue):
+    # Works through the cleanup jobs one chunk at a time, each chunk on the
+    # writer and with a pause after it so upserts get the database in
+    # between. Whatever is left when the cycle's time runs out waits for
+    # the next cycle.
+    now = datetime.utcnow()
+    jobs = [
+        # Remove active modifier from expired lured pokestops
+        ('pokestop', clean_lures, (now,)),
+        # Clean out old scanned locations and worker statuses
+        ('scannedlocation', clean_rows,
+         (ScannedLocation, ScannedLocation.last_modified < now - timedelta(minutes=30))),
+        ('mainworker', clean_rows,
+         (MainWorker, MainWorker.last_modified < now - timedelta(minutes=30))),
+        ('workerstatus', clean_rows,
+         (WorkerStatus, WorkerStatus.last_modified < now - timedelta(minutes=30)))
+    ]
+
+    # If desired, clear old pokemon spawns
+    if args.purge_data > 0:
+        purge_before = now - timedelta(hours=args.purge_data)
+        if args.db_daily_pokemon:
+            run_as_writer(db_updates_queue, drop_pokemon_days, purge_before)
+        # The pokemon table from before the daily tables is purged by row.
+        if not args.db_daily_pokemon or Pokemon in Pokemon.partitions():
+            jobs.append(('pokemon', clean_rows, (Pokemon, Pokemon.disappear_time < purge_before)))
+
+    deadline = time.time() + db_clean_budget
+    for table, job, job_args in jobs:
+        changed = 0
+        spent = 0.0
+        more = True
+        while more and time.time() < deadline:
+            started = time.time()
+            rows, more = run_as_writer(db_updates_queue, job, *job_args)
+            spent += time.time() - started
+            changed += rows
+            if more:
+                time.sleep(db_clean_pause)
+
+        if changed or more:
+            log.info('Cleaned %d %s rows in %.2fs%s', changed, table, spent,
+                     ', the rest waits for the next run' if more else '')
+
+
+def chunk_condition(model, condition):
+    # Narrows condition down to the first db_clean_chunk matching rows in
+    # primary key order, so the statement only locks a range of the key.
+    # Also tells whether rows past the chunk may remain.
+    fields = model._meta.get_primary_key_fields()
+    last = list(model
+                .select(*fields)
+                .where(condition)
+                .order_by(*fields)
+                .offset(db_clean_chunk - 1)
+                .limit(1)
+                .tuples())
+    if not last:
+        return condition, False
+
+    # Up to and including the last key, compared field by field.
+    within = None
+    for field, value in reversed(zip(fields, last[0])):
+        if within is None:
+            within = field <= value
+        else:
+            within = (field < value) | ((field == value) & within)
+    return condition & within, True
+
+
+def clean_rows(model, condition):
+    condition, more = chunk_condition(model, condition)
+    return model.delete().where(condition).execute(), more
+
+
+def clean_lures(now):
+    condition, more = chunk_condition(Pokestop, Pokestop.lure_expiration < now)
+    pokestop_ids = []
+    if change_journal.enabled:
+        pokestop_ids = list(itertools.chain(*Pokestop
+                                            .select(Pokestop.pokestop_id)
+                                            .where(condition)
+                                            .tuples()))
+    rows = (Pokestop
+            .update(lure_expiration=None)
+            .where(condition)
+            .execute())
+    if rows and tile_cache.enabled:
+        tile_cache.clear('pokestop')
+    # Only once the lures are gone, so no token covers them early.
+    if pokestop_ids:
+        change_journal.record('pokestop', pokestop_ids)
+    return rows, more
+
+
+def drop_pokemon_days(purge_before):
+    # Whole days only; the rest of a day goes once all of it is old.
+    for model in Pokemon.partitions(end=purge_before - timedelta(days=1)):
+        if model is Pokemon:
+            continue
+        log.info('Dropping Pokemon table %s', model._meta.db_table)
+        model.drop_table(fail_silently=True)
+    get_partition_days(refresh=True)
 
-    if args.db_type == 'mysql':
-        step = 120
-    else:
-        # SQLite has a default max number of parameters of 999,
-        # so we need to limit how many rows we insert for it.
-        step = 50
 
-    while i < num_rows:
-        log.debug('Inserting items %d to %d', i, min(i + step, num_rows))
+def archive_loop(args, db_updates_queue):
+    if not os.path.isdir(args.archive_dir):
+        os.makedirs(args.archive_dir)
+    while True:
         try:
-            InsertQuery(cls, rows=data.values()[i:min(i + step, num_rows)]).upsert().execute()
+            archive_pokemon(args, db_updates_queue)
+            time.sleep(60)
         except Exception as e:
-            log.warning('%s... Retrying', e)
-            continue
+            log.exception('Exception in archive_loop: %s', e)
+            time.sleep(60)
 
-        i += step
+
+def archive_pokemon(args, db_updates_queue):
+    # Appends the Pokemon that disappeared before the cutoff to
+    # pokemon-YYYYMMDD.ndjson.gz in the archive dir, a chunk at a time in
+    # key order. A chunk is only deleted once its files are synced, so a
+    # crash can at worst archive some rows twice.
+    archive_before = datetime.utcnow() - timedelta(hours=args.archive_hours)
+    deadline = time.time() + db_clean_budget
+    archived = 0
+    started = time.time()
+    for model in Pokemon.partitions(end=archive_before):
+        condition = model.disappear_time < archive_before
+        more = True
+        while more and time.time() < deadline:
+            rows = list(model
+                        .select()
+                        .where(condition)
+                        .order_by(model.encounter_id)
+                        .limit(db_clean_chunk)
+                        .dicts())
+            more = len(rows) == db_clean_chunk
+            if not rows:
+                break
+            condition = (model.disappear_time < archive_before) & (model.encounter_id > rows[-1]['encounter_id'])
+
+            days = {}
+            for p in rows:
+                days.setdefault(p['disappear_time'].date(), []).append(p)
+            for day, day_rows in days.items():
+                write_archive(args.archive_dir, day, day_rows)
+
+            run_as_writer(db_updates_queue, delete_archived, model, [p['encounter_id'] for p in rows])
+            archived += len(rows)
+            time.sleep(db_clean_pause)
+
+        # A daily table whose whole day is archived is empty now.
+        if not more and model is not Pokemon and \
+                model._meta.db_table < 'pokemon_' + archive_before.strftime('%Y%m%d'):
+            run_as_writer(db_updates_queue, drop_archived_day, model)
+
+    if archived:
+        log.info('Archived %d Pokemon in %.2fs', archived, time.time() - started)
+
+
+def write_archive(archive_dir, day, rows):
+    path = os.path.join(archive_dir, 'pokemon-{}.ndjson.gz'.format(day.strftime('%Y%m%d')))
+    new = not os.path.exists(path)
+    # Every append adds a gzip member; gzip readers read them as one stream.
+    with open(path, 'ab') as f:
+        archive = gzip.GzipFile(fileobj=f, mode='ab')
+        for p in rows:
+            # With the encounter ids the map and webhooks send.
+            p = dict(p, encounter_id=encounter_id_to_api(p['encounter_id']),
+                     disappear_time=p['disappear_time'].strftime('%Y-%m-%d %H:%M:%S'))
+            archive.write(json.dumps(p, sort_keys=True) + '\n')
+        archive.close()
+        f.flush()
+        os.fsync(f.fileno())
+    if new:
+        # Make the new file's directory entry durable too.
+        fd = os.open(archive_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def delete_archived(model, encounter_ids):
+    return model.delete().where(model.encounter_id << encounter_ids).execute()
+
+
+def drop_archived_day(model):
+    log.info('Dropping archived Pokemon table %s', model._meta.db_table)
+    model.drop_table(fail_silently=True)
+    get_partition_days(refresh=True)
+
+
+def db_upsert(cls, data):
+    # Upsert the rows and keep the tables derived from them in step. The
+    # caller commits, then calls db_upserted.
+    if cls is Pokemon:
+        # Creates the missing daily tables before writing anything, since
+        # MySQL commits whatever the transaction holds before DDL.
+        tables = partition_rows(data) if args.db_daily_pokemon else {Pokemon: data}
+        # The rollups and spawnpoints count the encounters this write
+        # inserted, committed along with them, so none is counted twice or
+        # for a write that failed.
+        with flaskDb.database.atomic():
+            stored = Pokemon.get_stored(data.values())
+            new_pokemon = []
+            for model, rows in tables.items():
+                # A sighting stored in another table (the pokemon table from
+                # before the daily ones, or another day's before its
+                # disappear_time was corrected) moves to this one, so it is
+                # never in two tables.
+                moved = {}
+                for p in rows.values():
+                    if stored.get(p['encounter_id'], model) is not model:
+                        moved.setdefault(stored[p['encounter_id']], []).append(p['encounter_id'])
+                for old_model, encounter_ids in moved.items():
+                    for i in range(0, len(encounter_ids), 500):
+                        (old_model
+                         .delete()
+                         .where(old_model.encounter_id << encounter_ids[i:i + 500])
+                         .execute())
+
+                inserted = insert_new(model, [p for p in rows.values() if p['encounter_id'] not in stored])
+                new_pokemon += inserted
+                inserted = set(p['encounter_id'] for p in inserted)
+                bulk_upsert(model, dict((key, p) for key, p in rows.items()
+                                        if p['encounter_id'] not in inserted))
+            if new_pokemon:
+                PokemonRollup.add(new_pokemon)
+                Spawnpoint.add(new_pokemon)
+    else:
+        bulk_upsert(cls, data)
+
+
+def db_upserted(cls, data):
+    # Brings the caches and the change journal up to date with rows that
+    # db_upsert wrote, once they are committed. Before that, a token could
+    # cover rows that other connections can't read yet, a tile could be
+    # loaded without them and a write that is rolled back would still count
+    # as written.
+    if cls in fort_fingerprint_fields:
+        fort_fingerprints.update(zip(row_keys(cls, data.values()),
+                                     (fort_fingerprint(cls, row) for row in data.values())))
+
+    # Tiles first: a token covering these rows must not be handed out with
+    # a tile that predates them.
+    if tile_cache.enabled:
+        tile_cache.invalidate(cls._meta.db_table, [(row['latitude'], row['longitude'])
+                                                   for row in data.values()
+                                                   if 'latitude' in row])
+
+    if change_journal.enabled:
+        change_journal.record(cls._meta.db_table, row_keys(cls, data.values()))
+
+
+def db_write_failed(pending):
+    # The rows are dropped, but new sightings among them are written if a
+    # scan sees them again.
+    for model, rows in pending.items():
+        log.error('Dropped %d %s rows that could not be written', len(rows), model.__name__)
+        if model is Pokemon:
+            seen_encounters.discard(rows.keys())
+
+
+def get_partition_model(day):
+    # The model of the daily Pokemon table for `day`.
+    model = partition_models.get(day)
+    if model is None:
+        suffix = day.strftime('%Y%m%d')
+        meta = type('Meta', (), {'db_table': 'pokemon_' + suffix})
+        model = type('Pokemon' + suffix, (Pokemon,), {'Meta': meta, '__module__': __name__})
+        partition_models[day] = model
+    return model
+
+
+def get_partition_days(refresh=False):
+    # Re-read every minute, so an instance that only serves the map sees
+    # the tables its searchers create.
+    with partition_lock:
+        if refresh or not partition_days or time.time() - partition_days[0] > 60:
+            days = set()
+            for table in flaskDb.database.get_tables():
+                match = re.match(r'pokemon_(\d{8})$', table)
+                if match:
+                    days.add(datetime.strptime(match.group(1), '%Y%m%d').date())
+            legacy = Pokemon.table_exists() and Pokemon.select(Pokemon.encounter_id).limit(1).exists()
+            partition_days[:] = [time.time(), days, legacy]
+        return partition_days[1]
+
+
+def partition_rows(data):
+    # Split Pokemon rows by the day they disappear, creating missing tables.
+    days = {}
+    for key, row in data.items():
+        days.setdefault(row['disappear_time'].date(), {})[key] = row
+
+    partitions = {}
+    existing = get_partition_days()
+    for day, rows in days.items():
+        model = get_partition_model(day)
+        if day not in existing:
+            model.create_table(fail_silently=True)
+            existing = get_partition_days(refresh=True)
+        partitions[model] = rows
+    return partitions
+
+
+def encounter_id_to_db(encounter_id):
+    # Same 64 bits, read as a signed number.
+    encounter_id = int(encounter_id)
+    if encounter_id >= 2 ** 63:
+        encounter_id -= 2 ** 64
+    return encounter_id
+
+
+def encounter_id_to_api(encounter_id):
+    # What the map and webhooks have always been sent.
+    if encounter_id < 0:
+        encounter_id += 2 ** 64
+    return b64encode(str(encounter_id))
+
+
+def fort_fingerprint(cls, row):
+    return tuple(row[field] for field in fort_fingerprint_fields[cls])
+
+
+def row_keys(cls, rows):
+    # Primary key values of row dicts, as tuples for composite keys.
+    names = [f.name for f in cls._meta.get_primary_key_fields()]
+    if len(names) == 1:
+        return [row[names[0]] for row in rows]
+    return [tuple(row[name] for name in names) for row in rows]
+
+
+def bulk_upsert(cls, data):
+    rows = data.values()
+    if not rows:
+        return
+
+    db = flaskDb.database
+    # One prepared single-row statement, executed for every row of a batch.
+    # SQLite reuses the statement per row, so its limit on bound variables
+    # doesn't apply; PyMySQL folds the rows into multi-row statements as
+    # long as max_allowed_packet allows.
+    query = InsertQuery(cls, rows=rows[:1]).upsert()
+    sql = query.sql()[0]
+    fields = sorted(next(query._iter_rows()).keys(), key=operator.attrgetter('_sort_key'))
+    step = max(1, db_batch_values // len(fields))
+
+    for i in range(0, len(rows), step):
+        log.debug('Inserting items %d to %d', i, min(i + step, len(rows)))
+        # Defaults are filled in the same way the single-row query did.
+        params = [[field.db_value(row[field]) for field in fields]
+                  for row in InsertQuery(cls, rows=rows[i:i + step])._iter_rows()]
+
+        # A savepoint within the caller's transaction, if there is one.
+        with db.atomic():
+            execute_rows(db, sql, params)
+
+
+def insert_new(cls, rows):
+    # Inserts the rows whose keys aren't taken yet and returns those. The
+    # insert itself decides, so of two writers adding the same row only one
+    # gets it back.
+    if not rows:
+        return []
+
+    db = flaskDb.database
+    query = InsertQuery(cls, rows=rows[:1])
+    sql = query.sql()[0].replace('INSERT INTO', 'INSERT IGNORE INTO' if args.db_type == 'mysql'
+                                 else 'INSERT OR IGNORE INTO', 1)
+    fields = sorted(next(query._iter_rows()).keys(), key=operator.attrgetter('_sort_key'))
+    params = [[field.db_value(row[field]) for field in fields]
+              for row in InsertQuery(cls, rows=rows)._iter_rows()]
+
+    # Usually no one else wrote any of them, and one statement does.
+    with db.atomic() as batch:
+        if execute_rows(db, sql, params) == len(params):
+            return rows
+        batch.rollback()
+    # Otherwise row by row, to tell which rows were ours.
+    return [row for row, row_params in zip(rows, params)
+            if execute_rows(db, sql, [row_params])]
+
+
+def execute_rows(db, sql, params):
+    # Runs the single-row statement for every row, returning the rows changed.
+    cursor = db.get_cursor()
+    if args.db_type == 'mysql':
+        cursor.max_stmt_length = get_max_stmt_length(db)
+    cursor.executemany(sql, params)
+    return cursor.rowcount
+
+
+def get_max_stmt_length(db):
+    # Leave room for the packet header and the statement around the values.
+    if not max_stmt_length:
+        packet = db.execute_sql('SELECT @@max_allowed_packet').fetchone()[0]
+        max_stmt_length.append(int(packet) - 16 * 1024)
+    return max_stmt_length[0]
 
 
 def create_tables(db):
     db.connect()
     verify_database_schema(db)
-    db.create_tables([Pokemon, Pokestop, Gym, ScannedLocation, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus], safe=True)
+    new_rollups = not PokemonRollup.table_exists()
+    new_spawnpoints = not Spawnpoint.table_exists()
+    db.create_tables([Pokemon, Pokestop, Gym, ScannedLocation, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus, PokemonRollup, Spawnpoint], safe=True)
+    if new_rollups:
+        PokemonRollup.backfill()
+    if new_spawnpoints:
+        Spawnpoint.backfill()
+    check_query_plans(db)
     db.close()
 
 
+def check_query_plans(db):
+    # Warns about the hot Pokemon reads the database would answer by
+    # scanning the whole table, e.g. when the indexes are missing.
+    now = datetime.utcnow()
+    queries = {
+        'active Pokemon': (Pokemon
+                           .select()
+                           .where((Pokemon.disappear_time > now) &
+                                  (Pokemon.latitude >= 0) & (Pokemon.longitude >= 0) &
+                                  (Pokemon.latitude <= 1) & (Pokemon.longitude <= 1))),
+        'appearances': (Pokemon
+                        .select(Pokemon.latitude, Pokemon.longitude, Pokemon.spawnpoint_id, fn.Count(Pokemon.spawnpoint_id))
+                        .where((Pokemon.pokemon_id == 1) & (Pokemon.disappear_time > now))
+                        .group_by(Pokemon.latitude, Pokemon.longitude, Pokemon.pokemon_id, Pokemon.spawnpoint_id)),
+        'appearance times': (Pokemon
+                             .select(Pokemon.disappear_time)
+                             .where((Pokemon.pokemon_id == 1) & (Pokemon.spawnpoint_id == '') &
+                                    (Pokemon.disappear_time > now))
+                             .order_by(Pokemon.disappear_time))
+    }
+
+    for name, query in queries.items():
+        sql, params = query.sql()
+        if args.db_type == 'mysql':
+            cursor = db.execute_sql('EXPLAIN ' + sql, params)
+            columns = [c[0] for c in cursor.description]
+            plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            scans = [row for row in plan if row['type'] == 'ALL']
+        else:
+            plan = [row[-1] for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+            scans = [row for row in plan if row.startswith('SCAN') and 'INDEX' not in row]
+        log.debug('Query plan for %s: %s', name, plan)
+        if scans:
+            log.warning('The database scans the whole Pokemon table for %s: %s', name, scans)
+
+
 def drop_tables(db):
     db.connect()
-    db.drop_tables([Pokemon, Pokestop, Gym, ScannedLocation, Versions, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus, Versions], safe=True)
+    db.drop_tables([Pokemon, Pokestop, Gym, ScannedLocation, Versions, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus, Versions, PokemonRollup, Spawnpoint] +
+                   [get_partition_model(day) for day in get_partition_days(refresh=True)], safe=True)
     db.close()
 
 
@@ -1015,3 +2141,80 @@ def database_migrate(db, old_ver):
             migrator.drop_column('gymdetails', 'description'),
             migrator.add_column('gymdetails', 'description', TextField(null=True, default=""))
         )
+
+    if old_ver < 8:
+        # The composite indexes start with the columns the old single column
+        # ones covered, so those can go.
+        tables = ['pokemon'] + [get_partition_model(day)._meta.db_table
+                                for day in get_partition_days(refresh=True)]
+        for table in set(tables) & set(db.get_tables()):
+            log.info('Rebuilding the indexes of %s, this can take a while', table)
+            existing = set(index.name for index in db.get_indexes(table))
+            old_indexes = [db.compiler().index_name(table, columns)
+                           for columns in (['spawnpoint_id'], ['pokemon_id'], ['disappear_time'],
+                                           ['latitude', 'longitude'])]
+            migrate(*([migrator.drop_index(table, name) for name in old_indexes if name in existing] +
+                      [migrator.add_index(table, columns, unique) for columns, unique in pokemon_indexes
+                       if db.compiler().index_name(table, columns) not in existing]))
+
+    if old_ver < 9:
+        models = [Pokemon] + [get_partition_model(day) for day in get_partition_days(refresh=True)]
+        for model in models:
+            if model.table_exists():
+                migrate_encounter_ids(db, migrator, model)
+
+
+def migrate_encounter_ids(db, migrator, model):
+    # Rebuilds a Pokemon table from the base64 encoded encounter ids it had
+    # before schema 9.
+    table = model._meta.db_table
+    log.info('Converting the encounter ids of %s to integers, this can take a while', table)
+    old_table = table + '_v8'
+    migrate(migrator.rename_table(table, old_table))
+    # Index names are global in SQLite, and the new table wants them.
+    for index in db.get_indexes(old_table):
+        if index.name != 'PRIMARY' and not index.name.startswith('sqlite_'):
+            migrate(migrator.drop_index(old_table, index.name))
+    model.create_table()
+
+    old = type('OldPokemon', (BaseModel,), {
+        'encounter_id': CharField(primary_key=True, max_length=50),
+        'spawnpoint_id': CharField(),
+        'pokemon_id': IntegerField(),
+        'latitude': DoubleField(),
+        'longitude': DoubleField(),
+        'disappear_time': DateTimeField(),
+        'Meta': type('Meta', (), {'db_table': old_table}),
+        '__module__': __name__
+    })
+
+    converted = 0
+    skipped = 0
+    condition = old.encounter_id > ''
+    while True:
+        rows = list(old
+                    .select()
+                    .where(condition)
+                    .order_by(old.encounter_id)
+                    .limit(db_batch_values)
+                    .dicts())
+        if not rows:
+            break
+        condition = old.encounter_id > rows[-1]['encounter_id']
+
+        pokemons = {}
+        for p in rows:
+            try:
+                p['encounter_id'] = encounter_id_to_db(b64decode(p['encounter_id']))
+            except (TypeError, ValueError):
+                # Not an id from the api, e.g. from the fake api.
+                skipped += 1
+                continue
+            pokemons[p['encounter_id']] = p
+        # A chunk that fails for good stops the migration before the old
+        # table is dropped.
+        run_with_retries(bulk_upsert, model, pokemons)
+        converted += len(pokemons)
+
+    old.drop_table()
+    log.info('Converted %d encounter ids of %s, dropped %d that were not numbers', converted, table, skipped)
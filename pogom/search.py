@@ -34,7 +34,8 @@ from pgoapi.utilities import f2i
 from pgoapi import utilities as util
 from pgoapi.exceptions import AuthException
 
-from .models import parse_map, GymDetails, parse_gyms, MainWorker, WorkerStatus
+from .models import parse_map, GymDetails, parse_gyms, MainWorker, WorkerStatus, ScannedLocation, \
+    run_as_writer, seen_encounters, pending_gym_details, scanned_locations
 from .fakePogoApi import FakePogoApi
 from .utils import now
 import schedulers
@@ -113,8 +114,8 @@ def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue,
 
             # Get the terminal size
             width, height = terminalsize.get_terminal_size()
-            # Queue and overseer take 2 lines.  Switch message takes up 2 lines.  Remove an extra 2 for things like screen status lines.
-            usable_height = height - 6
+            # Queue, duplicate sightings and overseer take 3 lines.  Switch message takes up 2 lines.  Remove an extra 2 for things like screen status lines.
+            usable_height = height - 7
             # Prevent people running terminals only 6 lines high from getting a divide by zero
             if usable_height < 1:
                 usable_height = 1
@@ -126,7 +127,9 @@ def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue,
                     skip_total += threadStatus[item]['skip']
 
             # Print the queue length
-            status_text.append('Queues: {} search items, {} db updates, {} webhook.  Total skipped items: {}. Spare accounts available: {}. Accounts on hold: {}'.format(search_items_queue.qsize(), db_updates_queue.qsize(), wh_queue.qsize(), skip_total, account_queue.qsize(), len(account_failures)))
+            status_text.append('Queues: {} search items, {} db updates ({} puts blocked for {:.0f}s), {} webhook ({} puts blocked for {:.0f}s).  Total skipped items: {}. Spare accounts available: {}. Accounts on hold: {}'.format(search_items_queue.qsize(), db_updates_queue.qsize(), db_updates_queue.blocked_puts, db_updates_queue.blocked_time, wh_queue.qsize(), wh_queue.blocked_puts, wh_queue.blocked_time, skip_total, account_queue.qsize(), len(account_failures)))
+
+            status_text.append('Duplicate sightings skipped: {:.0%} ({} of {})'.format(seen_encounters.hit_rate(), seen_encounters.hits, seen_encounters.hits + seen_encounters.misses))
 
             # Print status of overseer
             status_text.append('{} Overseer: {}'.format(threadStatus['Overseer']['scheduler'], threadStatus['Overseer']['message']))
@@ -218,35 +221,65 @@ def account_recycler(accounts_queue, account_failures, args):
                 log.info('Account {} needs to cool off for {} seconds due to {}'.format(a['account']['username'], a['last_fail_time'] - ok_time, a['reason']))
 
 
-def worker_status_db_thread(threads_status, name, db_updates_queue):
-    log.info("Clearing previous statuses for '%s' worker", name)
-    WorkerStatus.delete().where(WorkerStatus.worker_name == name).execute()
+def bookkeeping_db_thread(args, threads_status, db_updates_queue):
+    # Writes the scanned locations collected by parse_map, and with
+    # --status-name the worker statuses, every few seconds. Statuses are
+    # only rewritten when they changed, or once a minute so they don't look
+    # stale on the status page.
+    name = args.status_name
+    if name is not None:
+        log.info("Clearing previous statuses for '%s' worker", name)
+        run_as_writer(db_updates_queue,
+                      WorkerStatus.delete().where(WorkerStatus.worker_name == name).execute)
+
+    last_written = {}
+    heartbeat = 0
 
     while True:
-        workers = {}
-        overseer = None
-        for status in threads_status.values():
-            if status['type'] == 'Overseer':
-                overseer = {
-                    'worker_name': name,
-                    'message': status['message'],
-                    'method': status['scheduler'],
-                    'last_modified': datetime.utcnow()
-                }
-            if status['type'] == 'Worker':
-                workers[status['user']] = {
-                    'username': status['user'],
-                    'worker_name': name,
-                    'success': status['success'],
-                    'fail': status['fail'],
-                    'no_items': status['noitems'],
-                    'skip': status['skip'],
-                    'last_modified': datetime.utcnow(),
-                    'message': status['message']
-                }
-        if overseer is not None:
-            db_updates_queue.put((MainWorker, {0: overseer}))
-            db_updates_queue.put((WorkerStatus, workers))
+        scanned = scanned_locations.drain()
+        if scanned:
+            db_updates_queue.put((ScannedLocation, scanned))
+
+        if name is not None:
+            refresh = time.time() - heartbeat >= 60
+            if refresh:
+                heartbeat = time.time()
+
+            workers = {}
+            overseer = None
+            for status in threads_status.values():
+                if status['type'] == 'Overseer':
+                    overseer = {
+                        'worker_name': name,
+                        'message': status['message'],
+                        'method': status['scheduler'],
+                        'last_modified': datetime.utcnow()
+                    }
+                if status['type'] == 'Worker':
+                    workers[status['user']] = {
+                        'username': status['user'],
+                        'worker_name': name,
+                        'success': status['success'],
+                        'fail': status['fail'],
+                        'no_items': status['noitems'],
+                        'skip': status['skip'],
+                        'last_modified': datetime.utcnow(),
+                        'message': status['message']
+                    }
+            if overseer is not None:
+                # Compare everything but the time.
+                changed = {}
+                for key, row in [(None, overseer)] + workers.items():
+                    values = tuple(v for k, v in sorted(row.items()) if k != 'last_modified')
+                    if refresh or last_written.get(key) != values:
+                        changed[key] = row
+                        last_written[key] = values
+
+                if None in changed:
+                    db_updates_queue.put((MainWorker, {0: changed.pop(None)}))
+                if changed:
+                    db_updates_queue.put((WorkerStatus, changed))
+
         time.sleep(3)
 
 
@@ -291,13 +324,12 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb, encrypti
     t.daemon = True
     t.start()
 
-    if args.status_name is not None:
-        log.info('Starting status database thread')
-        t = Thread(target=worker_status_db_thread,
-                   name='status_worker_db',
-                   args=(threadStatus, args.status_name, db_updates_queue))
-        t.daemon = True
-        t.start()
+    log.info('Starting bookkeeping database thread')
+    t = Thread(target=bookkeeping_db_thread,
+               name='bookkeeping-db',
+               args=(args, threadStatus, db_updates_queue))
+    t.daemon = True
+    t.start()
 
     # Create specified number of search_worker_thread
     log.info('Starting search worker threads')
@@ -449,6 +481,17 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                         account_failures.append({'account': account, 'last_fail_time': now(), 'reason': 'rest interval'})
                         break
 
+                # Don't add to the db/webhook queues while they are backed up;
+                # searchers resume as they drain, so the scan rate settles at
+                # what the database and webhooks can keep up with.
+                first_loop = True
+                while dbq.over_high_water() or whq.over_high_water():
+                    status['message'] = 'Waiting for the db/webhook queues to drain ({} db updates, {} webhook)'.format(dbq.qsize(), whq.qsize())
+                    if first_loop:
+                        log.info(status['message'])
+                        first_loop = False
+                    time.sleep(1)
+
                 # Grab the next thing to search (when available)
                 status['message'] = 'Waiting for item from queue'
                 step, step_location, appears, leaves = search_items_queue.get()
@@ -524,27 +567,29 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                 if args.gym_info and parsed:
                     # build up a list of gyms to update
                     gyms_to_update = {}
+                    nearby_gyms = {}
                     for gym in parsed['gyms'].values():
                         # Can only get gym details within 1km of our position
                         distance = calc_distance(step_location, [gym['latitude'], gym['longitude']])
                         if distance < 1:
-                            # check if we already have details on this gym (if not, get them)
-                            try:
-                                record = GymDetails.get(gym_id=gym['gym_id'])
-                            except GymDetails.DoesNotExist as e:
-                                gyms_to_update[gym['gym_id']] = gym
-                                continue
-
-                            # if we have a record of this gym already, check if the gym has been updated since our last update
-                            if record.last_scanned < gym['last_modified']:
-                                gyms_to_update[gym['gym_id']] = gym
-                                continue
-                            else:
-                                log.debug('Skipping update of gym @ %f/%f, up to date', gym['latitude'], gym['longitude'])
-                                continue
+                            nearby_gyms[gym['gym_id']] = gym
                         else:
                             log.debug('Skipping update of gym @ %f/%f, too far away from our location at %f/%f (%fkm)', gym['latitude'], gym['longitude'], step_location[0], step_location[1], distance)
 
+                    # when we last got details of these gyms, if ever
+                    last_scanned = GymDetails.get_last_scanned(nearby_gyms.keys()) if nearby_gyms else {}
+                    for gym in nearby_gyms.values():
+                        # details we just got are still being written
+                        if gym['gym_id'] in pending_gym_details:
+                            log.debug('Skipping update of gym @ %f/%f, details pending', gym['latitude'], gym['longitude'])
+                            continue
+
+                        # check if the gym has been updated since our last update (or we never got its details)
+                        if gym['gym_id'] not in last_scanned or last_scanned[gym['gym_id']] < gym['last_modified']:
+                            gyms_to_update[gym['gym_id']] = gym
+                        else:
+                            log.debug('Skipping update of gym @ %f/%f, up to date', gym['latitude'], gym['longitude'])
+
                     if len(gyms_to_update):
                         gym_responses = {}
                         current_gym = 1
@@ -569,7 +614,7 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                         log.debug(status['message'])
 
                         if gym_responses:
-                            parse_gyms(args, gym_responses, whq)
+                            parse_gyms(args, gym_responses, whq, dbq)
 
                 # Record the time and place the worker left off at
                 status['last_scan_time'] = now()
@@ -1,5 +1,6 @@
 import math
 import geopy
+import geopy.distance
 
 a = 6378245.0
 ee = 0.00669342162296594323
@@ -54,3 +55,43 @@ def get_new_coords(init_loc, distance, bearing):
     origin = geopy.Point(init_loc[0], init_loc[1])
     destination = geopy.distance.distance(kilometers=distance).destination(origin, bearing)
     return (destination.latitude, destination.longitude)
+
+
+def get_meters_per_degree(latitude):
+    """
+    Returns the (north, east) length in meters of one degree around a latitude
+    on the WGS84 ellipsoid, for flat-earth distances over a few kilometers.
+    """
+    rad_lat = math.radians(latitude)
+    e2 = 0.00669437999014
+    w = 1 - e2 * math.sin(rad_lat) ** 2
+    # Meridional and prime vertical radii of curvature.
+    m = 6378137.0 * (1 - e2) / (w * math.sqrt(w))
+    n = 6378137.0 / math.sqrt(w)
+    return math.radians(m), math.radians(n * math.cos(rad_lat))
+
+
+def filter_within(center, points, radius):
+    """
+    Returns the points (dicts with lat and lng) within radius meters of
+    center. Distances are measured on the local tangent plane; only points
+    close enough to the edge for the approximation to matter are checked
+    with geopy.
+    """
+    lat_m, lng_m = get_meters_per_degree(center[0])
+    # Longitude degrees shrink towards the poles; scale them at the
+    # midpoint latitude rather than the center's.
+    lng_m /= math.cos(math.radians(center[0]))
+    # That is good to well under 0.1% over a hex, so anything outside this
+    # band is decided already.
+    inner = (radius * 0.999) ** 2
+    outer = (radius * 1.001) ** 2
+    filtered = []
+    for p in points:
+        dy = (p['lat'] - center[0]) * lat_m
+        dx = (p['lng'] - center[1]) * lng_m * math.cos(math.radians((p['lat'] + center[0]) / 2))
+        d = dx * dx + dy * dy
+        if d <= inner or (d <= outer and
+                          geopy.distance.distance(center, (p['lat'], p['lng'])).meters <= radius):
+            filtered.append(p)
+    return filtered
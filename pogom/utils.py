@@ -11,6 +11,9 @@ import platform
 import pprint
 import time
 
+from queue import Queue
+from threading import Lock
+
 from . import config
 
 log = logging.getLogger(__name__)
@@ -138,6 +141,11 @@ def get_args():
     parser.add_argument('-pd', '--purge-data',
                         help='Clear pokemon from database this many hours after they disappear \
                         (0 to disable)', type=int, default=0)
+    parser.add_argument('--archive-dir',
+                        help='Move Pokemon out of the database --archive-hours after they disappear, \
+                        into one gzipped JSON lines file per day in this directory', default=None)
+    parser.add_argument('--archive-hours', help='Hours after they disappear that Pokemon get archived',
+                        type=int, default=24)
     parser.add_argument('-px', '--proxy', help='Proxy url (e.g. socks5://127.0.0.1:9050)', action='append')
     parser.add_argument('-pxsc', '--proxy-skip-check', help='Disable checking of proxies before start', action='store_true', default=False)
     parser.add_argument('-pxt', '--proxy-timeout', help='Timeout settings for proxy checker in seconds ', type=int, default=5)
@@ -149,10 +157,23 @@ def get_args():
     parser.add_argument('--db-pass', help='Password for the database')
     parser.add_argument('--db-host', help='IP or hostname for the database')
     parser.add_argument('--db-port', help='Port for the database', type=int, default=3306)
+    parser.add_argument('--db-read-host', help='Read-only replica of the MySQL database to serve the map and stats from, \
+                        as host or host:port. Give it several times to spread the reads over several replicas',
+                        action='append', default=[])
     parser.add_argument('--db-max_connections', help='Max connections (per thread) for the database',
                         type=int, default=5)
+    parser.add_argument('--db-sqlite-wal', help='Run SQLite in WAL mode with a single writer thread, so the map and searchers can read while it writes. Implies --db-threads 1',
+                        action='store_true', default=False)
+    parser.add_argument('--db-daily-pokemon', help='Store Pokemon sightings in one table per day, so --purge-data drops whole days instead of deleting rows. Sightings already in the pokemon table are not moved; they are still shown, archived and purged row by row until none are left',
+                        action='store_true', default=False)
     parser.add_argument('--db-threads', help='Number of db threads; increase if the db queue falls behind',
                         type=int, default=1)
+    parser.add_argument('--delta-updates', help='Let map clients fetch only what changed since their last update. Only accurate if all searchers writing to the database run in this instance. Ignored with --only-server',
+                        action='store_true', default=False)
+    parser.add_argument('--live-pokemon', help='Serve active Pokemon from an in-memory index fed by this instance\'s searchers instead of querying the database. Ignored with --only-server',
+                        action='store_true', default=False)
+    parser.add_argument('--tile-cache', help='Share map query results between clients by caching them per map tile for a few seconds',
+                        action='store_true', default=False)
     parser.add_argument('-wh', '--webhook', help='Define URL(s) to POST webhook information to',
                         nargs='*', default=False, dest='webhooks')
     parser.add_argument('-gi', '--gym-info', help='Get all details about gyms (causes an additional API hit for every gym)',
@@ -163,6 +184,12 @@ def get_args():
                         action='store_true', default=False)
     parser.add_argument('--wh-threads', help='Number of webhook threads; increase if the webhook queue falls behind',
                         type=int, default=1)
+    parser.add_argument('--db-queue-size', help='Maximum number of pending db updates; searchers block when it is full (0 for no limit)',
+                        type=int, default=10000)
+    parser.add_argument('--wh-queue-size', help='Maximum number of pending webhook updates; searchers block when it is full (0 for no limit)',
+                        type=int, default=10000)
+    parser.add_argument('--queue-high-water', help='Percentage of --db-queue-size/--wh-queue-size above which searchers stop taking new locations until the queue drains',
+                        type=int, default=75)
     parser.add_argument('--ssl-certificate', help='Path to SSL certificate file')
     parser.add_argument('--ssl-privatekey', help='Path to SSL private key file')
     parser.add_argument('-ps', '--print-status', action='store_true',
@@ -348,6 +375,12 @@ def get_args():
         else:
             args.scheduler = 'HexSearch'
 
+    # WAL mode is an SQLite setting, replicas are MySQL ones.
+    if args.db_type == 'mysql':
+        args.db_sqlite_wal = False
+    else:
+        args.db_read_host = []
+
     return args
 
 
@@ -394,17 +427,32 @@ def get_pokemon_data(pokemon_id):
     return get_pokemon_data.pokemon[str(pokemon_id)]
 
 
+def get_pokemon_species():
+    # Translated name, rarity and types of every species, indexed directly by
+    # pokemon_id, so enriching a row doesn't redo the lookups and translation.
+    if not hasattr(get_pokemon_species, 'species'):
+        get_pokemon_data(1)
+        species = [None] * (max(int(k) for k in get_pokemon_data.pokemon) + 1)
+        for pokemon_id, data in get_pokemon_data.pokemon.items():
+            species[int(pokemon_id)] = {
+                'name': i8ln(data['name']),
+                'rarity': i8ln(data['rarity']),
+                'types': map(lambda x: {"type": i8ln(x['type']), "color": x['color']}, data['types'])
+            }
+        get_pokemon_species.species = species
+    return get_pokemon_species.species
+
+
 def get_pokemon_name(pokemon_id):
-    return i8ln(get_pokemon_data(pokemon_id)['name'])
+    return get_pokemon_species()[pokemon_id]['name']
 
 
 def get_pokemon_rarity(pokemon_id):
-    return i8ln(get_pokemon_data(pokemon_id)['rarity'])
+    return get_pokemon_species()[pokemon_id]['rarity']
 
 
 def get_pokemon_types(pokemon_id):
-    pokemon_types = get_pokemon_data(pokemon_id)['types']
-    return map(lambda x: {"type": i8ln(x['type']), "color": x['color']}, pokemon_types)
+    return get_pokemon_species()[pokemon_id]['types']
 
 
 def get_encryption_lib_path(args):
@@ -478,3 +526,32 @@ class Timer():
     def output(self):
         self.checkpoint('end')
         pprint.pprint(self.times)
+
+
+# A bounded Queue that also tells producers when to back off. It tracks how
+# long put() calls spent blocked on a full queue.
+class BackpressureQueue(Queue):
+
+    def __init__(self, maxsize=0, high_water=100):
+        Queue.__init__(self, maxsize)
+        # high_water is a percentage of maxsize.
+        self.high_water = maxsize * high_water / 100 if maxsize > 0 else 0
+        self.stats_lock = Lock()
+        self.blocked_puts = 0
+        self.blocked_time = 0.0
+
+    def put(self, item, block=True, timeout=None):
+        if not block or not self.full():
+            Queue.put(self, item, block, timeout)
+            return
+
+        start = time.time()
+        try:
+            Queue.put(self, item, block, timeout)
+        finally:
+            with self.stats_lock:
+                self.blocked_puts += 1
+                self.blocked_time += time.time() - start
+
+    def over_high_water(self):
+        return self.high_water > 0 and self.qsize() >= self.high_water
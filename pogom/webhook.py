@@ -38,7 +38,8 @@ def wh_updater(args, q):
                 whtype, message = q.get()
                 send_to_webhook(whtype, message)
                 if q.qsize() > 50:
-                    log.warning("Webhook queue is > 50 (@%d); try increasing --wh-threads", q.qsize())
+                    log.warning("Webhook queue is > 50 (@%d, %d puts blocked so far); try increasing --wh-threads",
+                                q.qsize(), q.blocked_puts)
                 q.task_done()
         except Exception as e:
             log.exception('Exception in wh_updater: %s', e)
@@ -20,10 +20,11 @@ from flask_cache_bust import init_cache_busting
 
 from pogom import config
 from pogom.app import Pogom
-from pogom.utils import get_args, get_encryption_lib_path, now
+from pogom.utils import get_args, get_encryption_lib_path, now, BackpressureQueue
 
 from pogom.search import search_overseer_thread
-from pogom.models import init_database, create_tables, drop_tables, Pokemon, db_updater, clean_db_loop
+from pogom.models import init_database, create_tables, drop_tables, Pokemon, db_updater, clean_db_loop, archive_loop, init_live_pokemon, change_journal, \
+    tile_cache
 from pogom.webhook import wh_updater
 
 from pogom.proxy import check_proxies
@@ -198,6 +199,13 @@ def main():
             os.remove(args.db)
     create_tables(db)
 
+    # Only the searchers in this process feed the in-memory index, so a
+    # webserver-only instance has to keep asking the database.
+    if args.live_pokemon and not args.only_server:
+        init_live_pokemon()
+    change_journal.enabled = args.delta_updates and not args.only_server
+    tile_cache.enabled = args.tile_cache
+
     app.set_current_location(position)
 
     # Control the search status (running or not) across threads
@@ -213,9 +221,12 @@ def main():
     new_location_queue.put(position)
 
     # DB Updates
-    db_updates_queue = Queue()
+    db_updates_queue = BackpressureQueue(args.db_queue_size, args.queue_high_water)
 
     # Thread(s) to process database updates
+    if args.db_sqlite_wal and args.db_threads > 1:
+        log.info('Using a single db thread, the only writer in SQLite WAL mode')
+        args.db_threads = 1
     for i in range(args.db_threads):
         log.debug('Starting db-updater worker thread %d', i)
         t = Thread(target=db_updater, name='db-updater-{}'.format(i), args=(args, db_updates_queue))
@@ -224,12 +235,17 @@ def main():
 
     # db clearner; really only need one ever
     if not args.disable_clean:
-        t = Thread(target=clean_db_loop, name='db-cleaner', args=(args,))
+        t = Thread(target=clean_db_loop, name='db-cleaner', args=(args, db_updates_queue))
+        t.daemon = True
+        t.start()
+
+    if args.archive_dir:
+        t = Thread(target=archive_loop, name='db-archiver', args=(args, db_updates_queue))
         t.daemon = True
         t.start()
 
     # WH Updates
-    wh_updates_queue = Queue()
+    wh_updates_queue = BackpressureQueue(args.wh_queue_size, args.queue_high_water)
 
     # Thread to process webhook updates
     for i in range(args.wh_threads):
@@ -26,6 +26,8 @@ var notifiedRarity = []
 
 var map
 var rawDataIsLoading = false
+var rawDataToken
+var rawDataQuery
 var locationMarker
 var rangeMarkers = ['pokemon', 'pokestop', 'gym']
 var searchMarker
@@ -866,20 +868,30 @@ function loadRawData () {
   var neLat = nePoint.lat()
   var neLng = nePoint.lng()
 
+  var data = {
+    'pokemon': loadPokemon,
+    'pokestops': loadPokestops,
+    'gyms': loadGyms,
+    'scanned': loadScanned,
+    'spawnpoints': loadSpawnpoints,
+    'swLat': swLat,
+    'swLng': swLng,
+    'neLat': neLat,
+    'neLng': neLng,
+    'format': 'columnar'
+  }
+
+  // Only ask for changes if the last response answered this same query;
+  // filters applied client side need a full refresh as well.
+  var query = JSON.stringify([data, excludedPokemon, Store.get('showLuredPokestopsOnly')])
+  if (rawDataToken && query === rawDataQuery) {
+    data['since'] = rawDataToken
+  }
+
   return $.ajax({
     url: 'raw_data',
     type: 'GET',
-    data: {
-      'pokemon': loadPokemon,
-      'pokestops': loadPokestops,
-      'gyms': loadGyms,
-      'scanned': loadScanned,
-      'spawnpoints': loadSpawnpoints,
-      'swLat': swLat,
-      'swLng': swLng,
-      'neLat': neLat,
-      'neLng': neLng
-    },
+    data: data,
     dataType: 'json',
     cache: false,
     beforeSend: function () {
@@ -889,12 +901,41 @@ function loadRawData () {
         rawDataIsLoading = true
       }
     },
+    success: function (result) {
+      rawDataToken = result.token
+      rawDataQuery = query
+      if (result.pokemons) {
+        result.pokemons = fromColumns(result.pokemons, 'pokemon_id', result.species)
+      }
+      if (result.pokestops) {
+        result.pokestops = fromColumns(result.pokestops)
+      }
+    },
     complete: function () {
       rawDataIsLoading = false
     }
   })
 }
 
+// Rebuilds the row objects of a columnar response. When a lookup is given,
+// the fields it holds for each row's `key` are copied onto the row too.
+function fromColumns (columns, key, lookup) {
+  var fields = Object.keys(columns)
+  var length = fields.length ? columns[fields[0]].length : 0
+  var rows = new Array(length)
+  for (var i = 0; i < length; i++) {
+    var row = {}
+    for (var j = 0; j < fields.length; j++) {
+      row[fields[j]] = columns[fields[j]][i]
+    }
+    if (lookup) {
+      $.extend(row, lookup[row[key]])
+    }
+    rows[i] = row
+  }
+  return rows
+}
+
 function processPokemons (i, item) {
   if (!Store.get('showPokemon')) {
     return false // in case the checkbox was unchecked in the meantime.
@@ -1021,6 +1062,13 @@ function updateMap () {
     showInBoundsMarkers(mapData.scanned, 'scanned')
     showInBoundsMarkers(mapData.spawnpoints, 'inbound')
 //    drawScanPath(result.scanned);
+    if (result.expired) {
+      $.each(result.expired.pokemons, function (i, id) {
+        if (id in mapData.pokemons) {
+          mapData.pokemons[id]['disappear_time'] = 0
+        }
+      })
+    }
     clearStaleMarkers()
     if ($('#stats').hasClass('visible')) {
       countMarkers()
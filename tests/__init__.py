@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# pogom reads its arguments on import; the tests run against a scratch
+# SQLite database. The map's parser needs the rest, but the tests don't
+# use them.
+scratch = tempfile.mktemp(suffix='.db')
+sys.argv = [sys.argv[0], '-os', '-l', '0,0', '-k', 'test', '-D', scratch]
+
+
+def teardown_package():
+    if os.path.exists(scratch):
+        os.remove(scratch)
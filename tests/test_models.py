@@ -0,0 +1,91 @@
+import os
+import unittest
+from datetime import datetime, timedelta
+
+from pogom import config
+from pogom.app import Pogom
+from pogom import models
+from pogom.models import init_database, create_tables, drop_tables, db_upsert, run_with_retries, \
+    get_partition_model, get_partition_days, Pokemon, Spawnpoint
+
+config['ROOT_PATH'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+db = init_database(Pogom(__name__))
+
+
+def sighting(encounter_id, disappear_time):
+    return {encounter_id: {
+        'encounter_id': encounter_id,
+        'spawnpoint_id': 'test',
+        'pokemon_id': 1,
+        'latitude': 1.0,
+        'longitude': 2.0,
+        'disappear_time': disappear_time
+    }}
+
+
+class DbTestCase(unittest.TestCase):
+
+    def setUp(self):
+        drop_tables(db)
+        create_tables(db)
+        db.connect()
+        get_partition_days(refresh=True)
+
+    def tearDown(self):
+        models.args.db_daily_pokemon = False
+        db.close()
+
+
+class DailyPokemonTest(DbTestCase):
+
+    def stored_in(self, encounter_id):
+        # Names of the tables holding the encounter.
+        return [model._meta.db_table for model in Pokemon.partitions()
+                if model.select().where(model.encounter_id == encounter_id).exists()]
+
+    def test_corrected_disappear_time_crossing_midnight(self):
+        models.args.db_daily_pokemon = True
+        midnight = datetime.combine(datetime.utcnow().date() + timedelta(days=1), datetime.min.time())
+        run_with_retries(db_upsert, Pokemon, sighting(7, midnight - timedelta(minutes=5)))
+        run_with_retries(db_upsert, Pokemon, sighting(7, midnight + timedelta(minutes=5)))
+
+        self.assertEqual(self.stored_in(7), [get_partition_model(midnight.date())._meta.db_table])
+
+    def test_sighting_from_before_daily_tables(self):
+        disappear_time = datetime.utcnow() + timedelta(minutes=10)
+        run_with_retries(db_upsert, Pokemon, sighting(8, disappear_time))
+        models.args.db_daily_pokemon = True
+        get_partition_days(refresh=True)
+        run_with_retries(db_upsert, Pokemon, sighting(8, disappear_time))
+
+        self.assertEqual(self.stored_in(8), [get_partition_model(disappear_time.date())._meta.db_table])
+        self.assertEqual([p['encounter_id'] for p in Pokemon.get_active(None, None, None, None)],
+                         [models.encounter_id_to_api(8)])
+
+
+class SpawnpointVoteTest(DbTestCase):
+
+    def vote(self, *seconds):
+        # One add() per call, as the db updater does per write.
+        hour = datetime(2017, 5, 1, 12)
+        Spawnpoint.add([{'spawnpoint_id': 'test',
+                         'latitude': 1.0,
+                         'longitude': 2.0,
+                         'disappear_time': hour + timedelta(seconds=sec)} for sec in seconds])
+        sp = Spawnpoint.get(Spawnpoint.spawnpoint_id == 'test')
+        return sp.despawn_sec, sp.despawn_votes, sp.count, sp.special
+
+    def test_replaced_by_majority(self):
+        self.assertEqual(self.vote(100), (100, 1, 1, False))
+        self.assertEqual(self.vote(200, 200, 200), (200, 2, 4, True))
+        self.assertEqual(self.vote(100), (200, 1, 5, True))
+
+    def test_tie_keeps_second_without_votes(self):
+        self.assertEqual(self.vote(100), (100, 1, 1, False))
+        self.assertEqual(self.vote(200), (100, 0, 2, True))
+        self.assertEqual(self.vote(300), (300, 1, 3, True))
+        self.assertEqual(self.vote(300), (300, 2, 4, True))
+
+
+if __name__ == '__main__':
+    unittest.main()